@@ -0,0 +1,495 @@
+"""Офлайн-бенчмарк та навантажувальний тест пересилання без підключення до Telegram.
+
+Запуск:
+    python benchmark.py --channels 2000 --rate 500 --duration 20 > bench_output.txt
+
+main.py імпортується з фіктивним config, а клієнт Telethon та бот aiogram
+замінюються імітаціями в пам'яті із заданою затримкою, FloodWait та збоями.
+Результат кожного сценарію виводиться окремим рядком JSON.
+"""
+import argparse
+import asyncio
+import collections
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+import types
+from datetime import datetime, timedelta, timezone
+
+from telethon import errors, utils
+from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.functions.messages import GetHistoryRequest, GetPeerDialogsRequest
+from telethon.tl.types import InputPeerChannel, Message, MessageFwdHeader, PeerChannel
+
+
+# Фіктивний config: бенчмарк ніколи не використовує справжні облікові дані
+def install_fake_config(args, workdir):
+    config = types.ModuleType('config')
+    config.api_id = 1
+    config.api_hash = '0' * 32
+    config.bot_token = '123456:' + 'A' * 35
+    config.my_id = 1
+    config.proxy_url = None
+    config.SESSIONS = [f'bench{index}' for index in range(args.sessions)]
+    config.DB_PATH = os.path.join(workdir, 'bench.db')
+    config.FORWARD_BATCH_WINDOW = args.batch_window
+    config.FORWARD_GLOBAL_RATE = args.global_rate
+    config.FORWARD_GLOBAL_BURST = args.global_rate
+    config.FORWARD_CHAT_RATE = args.global_rate
+    config.FORWARD_CHAT_BURST = args.global_rate
+    config.FORWARD_BACKOFF_BASE = 0.01
+    config.QUEUE_RETRY_BASE = 0.1
+    config.QUEUE_POLL_INTERVAL = 0.5
+    config.RESOLVE_RATE = args.global_rate
+    config.RESOLVE_BURST = args.global_rate
+    config.DEDUP_CAPACITY = 200000
+    config.DEDUP_LRU_SIZE = 20000
+    config.PROGRESS_EDIT_INTERVAL = 1.0
+    sys.modules['config'] = config
+
+
+# Імітація TelegramClient: історія каналів у пам'яті, ін'єкція подій,
+# пересилання з налаштовуваною затримкою, FloodWait та збоями.
+# Один екземпляр обслуговує всі сесії main.clients, кожна реєструє обробник лише для своїх каналів
+class FakeTelegramClient:
+    def __init__(self, latency, flood_rate, flood_seconds, failure_rate):
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.flood_seconds = flood_seconds
+        self.failure_rate = failure_rate
+        self.history = {}  # real channel id -> список повідомлень за зростанням ID
+        self.handlers = []  # (callback, event builder, множина дозволених chat_id або None)
+        self.injected_at = {}  # (real channel id, message id) -> час ін'єкції
+        self.latencies = []
+        self.deliveries = []  # (real channel id, message id, приймач) у порядку пересилання
+        self.destination_message_id = 0
+        self.api_calls = {'forward_messages': 0, 'get_history': 0, 'get_entity': 0, 'join_channel': 0, 'get_peer_dialogs': 0}
+
+    # Реєстрація обробників, як у Telethon: фільтр chats= застосовується до запуску корутини
+    def add_event_handler(self, callback, event):
+        chats = getattr(event, 'chats', None)
+        allowed = {utils.get_peer_id(chat) for chat in chats} if chats is not None else None
+        self.handlers.append((callback, event, allowed))
+
+    def remove_event_handler(self, callback, event=None):
+        self.handlers = [handler for handler in self.handlers if handler[0] is not callback]
+
+    def add_message(self, channel_id, text, date=None, grouped_id=None):
+        messages = self.history.setdefault(channel_id, [])
+        message = Message(
+            id=messages[-1].id + 1 if messages else 1,
+            peer_id=PeerChannel(channel_id),
+            date=date or datetime.now(timezone.utc),
+            message=text,
+            grouped_id=grouped_id,
+        )
+        messages.append(message)
+        return message
+
+    # Ін'єкція нового повідомлення як живої події Telethon
+    def inject(self, channel_id, text, grouped_id=None):
+        message = self.add_message(channel_id, text, grouped_id=grouped_id)
+        self.injected_at[channel_id, message.id] = time.perf_counter()
+        chat_id = utils.get_peer_id(PeerChannel(channel_id))
+        event = types.SimpleNamespace(chat_id=chat_id, message=message)
+        for callback, _, allowed in self.handlers:
+            if allowed is None or chat_id in allowed:
+                asyncio.create_task(callback(event))
+
+    async def __call__(self, request):
+        if isinstance(request, GetHistoryRequest):
+            self.api_calls['get_history'] += 1
+            await asyncio.sleep(self.latency)
+            return types.SimpleNamespace(messages=self.get_history(request))
+        if isinstance(request, GetPeerDialogsRequest):
+            self.api_calls['get_peer_dialogs'] += 1
+            await asyncio.sleep(self.latency)
+            return types.SimpleNamespace(dialogs=[
+                types.SimpleNamespace(peer=dialog.peer, top_message=self.history[dialog.peer.channel_id][-1].id)
+                for dialog in request.peers if self.history.get(dialog.peer.channel_id)
+            ])
+        if isinstance(request, JoinChannelRequest):
+            self.api_calls['join_channel'] += 1
+            await asyncio.sleep(self.latency)
+            return None
+        raise NotImplementedError(type(request).__name__)
+
+    # Спрощена семантика GetHistoryRequest: offset_id, add_offset, min_id, offset_date, limit
+    def get_history(self, request):
+        messages = self.history.get(request.peer.channel_id, [])
+        if request.add_offset < 0:
+            newer = [m for m in messages if m.id >= request.offset_id and m.id > request.min_id]
+            return list(reversed(newer[:request.limit]))
+        older = [
+            m for m in reversed(messages)
+            if (not request.offset_id or m.id < request.offset_id)
+            and (not request.offset_date or m.date < request.offset_date)
+            and m.id > request.min_id
+        ]
+        return older[request.add_offset:request.add_offset + request.limit]
+
+    async def forward_messages(self, entity, messages, from_peer=None):
+        self.api_calls['forward_messages'] += 1
+        await asyncio.sleep(self.latency)
+        roll = random.random()
+        if roll < self.flood_rate:
+            raise errors.FloodWaitError(None, capture=self.flood_seconds)
+        if roll < self.flood_rate + self.failure_rate:
+            raise errors.ServerError(None, 'BENCH_INJECTED_FAILURE')
+        now = time.perf_counter()
+        for message_id in messages:
+            injected = self.injected_at.pop((from_peer.channel_id, message_id), None)
+            if injected is not None:
+                self.latencies.append(now - injected)
+            self.deliveries.append((from_peer.channel_id, message_id, entity))
+        # Як і Telegram, повертає нові повідомлення в каналі-приймачі із заголовком пересилання
+        source = self.history.get(from_peer.channel_id, [])
+        forwarded = []
+        for message_id in messages:
+            original = source[message_id - 1] if 0 < message_id <= len(source) else None
+            self.destination_message_id += 1
+            forwarded.append(Message(
+                id=self.destination_message_id,
+                peer_id=PeerChannel(utils.resolve_id(entity)[0] if entity < 0 else entity),
+                date=datetime.now(timezone.utc),
+                message=original.message if original else '',
+                fwd_from=MessageFwdHeader(
+                    date=original.date if original else datetime.now(timezone.utc),
+                    from_id=from_peer,
+                    channel_post=message_id,
+                ),
+            ))
+        return forwarded
+
+    # Кеш сутностей сесії: без запиту до API, як get_input_entity для вже відомих каналів
+    async def get_input_entity(self, peer):
+        return InputPeerChannel(peer.channel_id, peer.channel_id * 7)
+
+    async def get_entity(self, target):
+        self.api_calls['get_entity'] += 1
+        await asyncio.sleep(self.latency)
+        if isinstance(target, str):
+            channel_id = int(target.rsplit('_', 1)[1])
+        else:
+            channel_id = utils.resolve_id(target)[0] if target < 0 else target
+        return types.SimpleNamespace(
+            id=channel_id, username=f'bench_{channel_id}', access_hash=channel_id * 7,
+            title=f'Bench {channel_id}', broadcast=True, megagroup=False
+        )
+
+
+# Імітація повідомлення aiogram, на яке бот відповідає
+class FakeBotMessage:
+    def __init__(self, bot, text='', user_id=1):
+        self.bot = bot
+        self.text = text
+        self.from_user = types.SimpleNamespace(id=user_id)
+
+    async def reply(self, text, **kwargs):
+        return await self.bot.send_message(None, text, **kwargs)
+
+    async def edit_text(self, text, **kwargs):
+        self.bot.edits += 1
+        self.text = text
+        return self
+
+    def get_args(self):
+        return self.text.partition(' ')[2]
+
+
+# Імітація aiogram Bot: запам'ятовує надіслані повідомлення та документи
+class FakeBot:
+    def __init__(self):
+        self.sent = []
+        self.edits = 0
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.sent.append(text)
+        return FakeBotMessage(self, text)
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.sent.append(document)
+        return FakeBotMessage(self)
+
+
+class FakeState:
+    async def finish(self):
+        pass
+
+
+# Перевірка доставки: кожне повідомлення переслано в приймач рівно один раз і в порядку ID
+# у межах смуги (джерело, приймач), а кожен очікуваний текст дійшов хоча б з одного каналу.
+# Повертає (кількість унікальних доставок, порушення)
+def check_deliveries(client, expected_texts):
+    delivered = set()
+    last_ids = {}
+    out_of_order = 0
+    for channel_id, message_id, destination in client.deliveries:
+        if (channel_id, message_id, destination) in delivered:
+            continue
+        delivered.add((channel_id, message_id, destination))
+        if message_id < last_ids.get((channel_id, destination), 0):
+            out_of_order += 1
+        else:
+            last_ids[channel_id, destination] = message_id
+    texts = {client.history[channel_id][message_id - 1].message for channel_id, message_id, _ in delivered}
+    return len(delivered), {
+        'duplicates_delivered': len(client.deliveries) - len(delivered),
+        'out_of_order': out_of_order,
+        'missing': len(set(expected_texts) - texts),
+    }
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+# Один сценарій: свіжа база даних, лічильник SQL-запитів та пікова пам'ять
+class Scenario:
+    def __init__(self, main, name, args):
+        self.main = main
+        self.name = name
+        self.args = args
+        self.db_ops = 0
+
+    async def __aenter__(self):
+        main = self.main
+        await main.close_db()
+        main.DB_PATH = os.path.join(os.path.dirname(main.DB_PATH), f'{self.name}.db')
+        main.metrics = main.Metrics()
+        main.fingerprint_index = main.FingerprintIndex(
+            main.DEDUP_WINDOW, main.DEDUP_LRU_SIZE, main.DEDUP_CAPACITY, main.DEDUP_ERROR_RATE
+        )
+        main.pending_fingerprints.clear()
+        main.client = FakeTelegramClient(self.args.latency, self.args.flood_rate, self.args.flood_seconds, self.args.failure_rate)
+        main.clients = {name: main.client for name in dict.fromkeys(main.SESSIONS + main.SENDER_SESSIONS)}
+        main.channel_sessions.clear()
+        main.session_banned_until.clear()
+        main.input_peers.clear()
+        main.gap_schedule.clear()
+        main.gap_top_ids.clear()
+        main.handled_through_ids.clear()
+        main.handled_ahead_ids.clear()
+        main.catchup_live_ids.clear()
+        main.rebuild_session_rings()
+        main.bot = FakeBot()
+        await main.init_db()
+        db = await main.get_db()
+        await db.set_trace_callback(self.count_statement)
+        if self.args.tracemalloc:
+            tracemalloc.start()
+        self.started = time.perf_counter()
+        return self
+
+    def count_statement(self, statement):
+        self.db_ops += 1
+
+    async def __aexit__(self, *exc_info):
+        await self.main.stop_forward_workers()
+        if tracemalloc.is_tracing():
+            self.peak_memory = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+        else:
+            self.peak_memory = None
+
+    def report(self, messages, extra=None):
+        elapsed = time.perf_counter() - self.started
+        client = self.main.client
+        result = {
+            'scenario': self.name,
+            'messages': messages,
+            'elapsed_seconds': round(elapsed, 3),
+            'throughput_per_second': round(messages / elapsed, 1) if elapsed else None,
+            'latency_p50_seconds': percentile(client.latencies, 0.5),
+            'latency_p99_seconds': percentile(client.latencies, 0.99),
+            'db_ops': self.db_ops,
+            'db_ops_per_message': round(self.db_ops / messages, 2) if messages else None,
+            'api_calls': client.api_calls,
+            'peak_memory_bytes': self.peak_memory,
+        }
+        result.update(extra or {})
+        print(json.dumps(result), flush=True)
+
+
+async def seed_channels(main, count, first_id=1000):
+    channel_ids = list(range(first_id, first_id + count))
+    await main.save_channels_bulk([(channel_id, f'Bench {channel_id}') for channel_id in channel_ids], {})
+    await main.set_destination_channel(1)
+    main.register_message_handler()
+    return channel_ids
+
+
+# Очікування, доки черга пересилання спорожніє
+async def wait_drained(main, timeout):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        count, _, _ = await main.get_queue_stats()
+        if not count and not main.forward_lanes:
+            return True
+        await asyncio.sleep(0.05)
+    return False
+
+
+# Живі події: рівномірний потік повідомлень із каналів, частина — з каналів поза моніторингом
+async def bench_live(main, args):
+    async with Scenario(main, 'live', args) as scenario:
+        channel_ids = await seed_channels(main, args.channels)
+        main.start_forward_workers()
+        client = main.client
+        total = int(args.rate * args.duration)
+        interval = 1 / args.rate
+        next_at = time.perf_counter()
+        # Повтор вмісту має дійти лише один раз, з будь-якого каналу
+        expected = set()
+        for index in range(total):
+            if random.random() < args.noise:
+                client.inject(10 ** 9 + index, 'noise')
+            channel_id = random.choice(channel_ids)
+            text = f'repost {index // 2}' if random.random() < args.duplicates else f'post {channel_id} {index}'
+            client.inject(channel_id, text)
+            expected.add(text)
+            next_at += interval
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        drained = await wait_drained(main, args.drain_timeout)
+    delivered, violations = check_deliveries(client, expected)
+    scenario.report(delivered, {
+        'injected': total, 'drained': drained, 'duplicates': main.dedup_stats['duplicates'], **violations,
+    })
+
+
+# Догонка: пропущена історія в кожному каналі після простою
+async def bench_backfill(main, args):
+    async with Scenario(main, 'backfill', args) as scenario:
+        channel_ids = await seed_channels(main, args.channels)
+        client = main.client
+        start = datetime.now(timezone.utc) - timedelta(minutes=30)
+        expected = []
+        for channel_id in channel_ids:
+            client.add_message(channel_id, f'seen {channel_id}', date=start)
+            await main.update_last_message_id(channel_id, 1)
+            for index in range(args.backfill_per_channel):
+                expected.append(client.add_message(channel_id, f'missed {channel_id} {index}', date=start + timedelta(seconds=index)).message)
+        main.start_forward_workers()
+        main.begin_catchup()
+        await main.check_missed_messages()
+        drained = await wait_drained(main, args.drain_timeout)
+    delivered, violations = check_deliveries(client, expected)
+    scenario.report(delivered, {'channels': len(channel_ids), 'drained': drained, **violations})
+
+
+# Пошук пропусків: один прохід планувальника, коли пропуск є лише в частині каналів
+async def bench_gaps(main, args):
+    async with Scenario(main, 'gaps', args) as scenario:
+        channel_ids = await seed_channels(main, args.channels)
+        client = main.client
+        start = datetime.now(timezone.utc) - timedelta(minutes=30)
+        gapped = set(random.sample(channel_ids, max(1, int(len(channel_ids) * args.gap_share))))
+        expected = []
+        for channel_id in channel_ids:
+            client.add_message(channel_id, f'seen {channel_id}', date=start)
+            await main.update_last_message_id(channel_id, 1)
+            if channel_id in gapped:
+                for index in range(args.backfill_per_channel):
+                    expected.append(client.add_message(channel_id, f'missed {channel_id} {index}', date=start + timedelta(seconds=index)).message)
+        main.gap_budget = main.TokenBucket(args.global_rate, args.global_rate)
+        main.start_forward_workers()
+        main.sync_gap_schedule()
+        for channel_id, (_, interval) in main.gap_schedule.items():
+            main.gap_schedule[channel_id] = (0, interval)
+        await main.check_gaps()
+        drained = await wait_drained(main, args.drain_timeout)
+    delivered, violations = check_deliveries(client, expected)
+    scenario.report(delivered, {
+        'channels': len(channel_ids), 'gapped_channels': len(gapped), 'drained': drained,
+        'gap_messages': main.metrics.counter('gap_messages_total'), **violations,
+    })
+
+
+# Масове додавання каналів через обробник бота
+async def bench_mass_add(main, args):
+    async with Scenario(main, 'mass_add', args) as scenario:
+        channel_ids = range(5000, 5000 + args.channels)
+        for channel_id in channel_ids:
+            main.client.add_message(channel_id, 'latest')
+        text = '\n'.join(f'@bench_{channel_id}' for channel_id in channel_ids)
+        await main.mass_add_channels_handler(FakeBotMessage(main.bot, text), FakeState())
+        saved = len(await main.get_channels())
+    scenario.report(saved, {'channels': args.channels, 'bot_edits': main.bot.edits})
+
+
+# Допоміжні функції бази даних: оновлення та читання last_message_id, збереження каналів
+async def bench_db_helpers(main, args):
+    async with Scenario(main, 'db_helpers', args) as scenario:
+        operations = args.channels * 10
+        for index in range(operations):
+            channel_id = index % args.channels
+            await main.update_last_message_id(channel_id, index)
+            await main.get_last_message_id(channel_id)
+        for channel_id in range(args.channels):
+            await main.save_channel(channel_id, f'Bench {channel_id}')
+        await main.flush_pending_writes()
+    scenario.report(operations + args.channels)
+
+
+SCENARIOS = {
+    'live': bench_live,
+    'backfill': bench_backfill,
+    'gaps': bench_gaps,
+    'mass_add': bench_mass_add,
+    'db_helpers': bench_db_helpers,
+}
+
+
+async def run(args, workdir):
+    import main
+    main.logger.setLevel(args.log_level)
+    try:
+        for name in args.scenarios:
+            await SCENARIOS[name](main, args)
+    finally:
+        await main.stop_forward_workers()
+        await main.close_db()
+        main.log_listener.stop()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--scenarios', nargs='+', choices=list(SCENARIOS), default=list(SCENARIOS))
+    parser.add_argument('--channels', type=int, default=2000, help='кількість каналів-джерел')
+    parser.add_argument('--sessions', type=int, default=1, help='кількість сесій Telethon')
+    parser.add_argument('--rate', type=float, default=500, help='живих повідомлень на секунду')
+    parser.add_argument('--duration', type=float, default=20, help='тривалість живого сценарію, с')
+    parser.add_argument('--backfill-per-channel', type=int, default=20)
+    parser.add_argument('--gap-share', type=float, default=0.05, help='частка каналів з пропуском у сценарії gaps')
+    parser.add_argument('--noise', type=float, default=0.5, help='частка подій з каналів поза моніторингом')
+    parser.add_argument('--duplicates', type=float, default=0.1, help='частка повторів вмісту')
+    parser.add_argument('--latency', type=float, default=0.02, help='затримка кожного виклику API, с')
+    parser.add_argument('--flood-rate', type=float, default=0.0, help='ймовірність FloodWait на пересилання')
+    parser.add_argument('--flood-seconds', type=int, default=1)
+    parser.add_argument('--failure-rate', type=float, default=0.0, help='ймовірність тимчасової помилки')
+    parser.add_argument('--global-rate', type=float, default=1000, help='ліміт запитів на секунду для main.py')
+    parser.add_argument('--batch-window', type=float, default=0.05)
+    parser.add_argument('--drain-timeout', type=float, default=120)
+    parser.add_argument('--no-tracemalloc', dest='tracemalloc', action='store_false')
+    parser.add_argument('--log-level', default='WARNING')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    random.seed(0)
+    with tempfile.TemporaryDirectory() as workdir:
+        install_fake_config(args, workdir)
+        # Файл сесії Telethon створюється в робочому каталозі під час імпорту main.py
+        sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+        os.chdir(workdir)
+        asyncio.run(run(args, workdir))
@@ -1,6 +1,22 @@
 import asyncio
+import bisect
+import collections
+import contextlib
+import csv
+import hashlib
+import io
+import itertools
+import json
 import logging
+import logging.handlers
+import math
 import os
+import queue
+import random
+import re
+import tempfile
+import time
+from datetime import datetime, timedelta, timezone
 
 import aiosqlite
 from aiogram import Bot, Dispatcher, types
@@ -8,10 +24,16 @@ from aiogram.contrib.fsm_storage.memory import MemoryStorage
 from aiogram.contrib.middlewares.logging import LoggingMiddleware
 from aiogram.dispatcher import FSMContext
 from aiogram.dispatcher.filters.state import State, StatesGroup
-from telethon import TelegramClient, events
-from telethon.tl.functions.messages import GetHistoryRequest
-from telethon.tl.types import PeerChannel
+from telethon import TelegramClient, errors, events, helpers, utils
+from telethon.tl.functions.channels import JoinChannelRequest
+from telethon.tl.functions.messages import GetHistoryRequest, GetPeerDialogsRequest, SendMultiMediaRequest, UploadMediaRequest
+from telethon.tl.types import (
+    DocumentAttributeFilename, InputDialogPeer, InputDocument, InputMediaDocument, InputMediaPhoto,
+    InputMediaUploadedDocument, InputMediaUploadedPhoto, InputPeerChannel, InputPhoto, InputSingleMedia, Message,
+    PeerChannel, UpdateMessageID, UpdateNewChannelMessage, UpdateNewMessage
+)
 
+import config
 from config import api_id, api_hash, bot_token, my_id, proxy_url
 
 # Визначення станів для очікування вводу
@@ -24,24 +46,415 @@ class MassChannelAdding(StatesGroup):
 class DestinationChannelSetting(StatesGroup):
     waiting_for_destination_channel_id = State()
 
+class ChannelSearching(StatesGroup):
+    waiting_for_query = State()
+
 # Налаштування логування
-logging.basicConfig(
-    level=logging.INFO,
-    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
-)
+LOG_LEVEL = getattr(config, 'LOG_LEVEL', 'INFO')
+LOG_FORMAT = getattr(config, 'LOG_FORMAT', 'text')  # 'text' або 'json'
+LOG_FILE = getattr(config, 'LOG_FILE', None)  # None — вивід у stderr
+LOG_SUMMARY_INTERVAL = getattr(config, 'LOG_SUMMARY_INTERVAL', 60.0)  # Секунд між підсумками по повідомленнях
+LOG_SAMPLE_RATE = getattr(config, 'LOG_SAMPLE_RATE', 0.01)  # Частка подій по повідомленнях, що логуються окремо
+LOG_SAMPLE_MAX = getattr(config, 'LOG_SAMPLE_MAX', 20)  # Найбільше окремих записів однієї події за інтервал підсумку
+
+# Структурований формат: один JSON-об'єкт на рядок
+class JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            'time': self.formatTime(record),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        if record.exc_info:
+            entry['exc_info'] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+# Записи передаються фоновому потоку без форматування: рядок будується лише там,
+# тому цикл подій не витрачає час ні на форматування, ні на запис на диск
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    def prepare(self, record):
+        return record
+
+# Обробники виводу працюють у потоці QueueListener, цикл подій лише кладе запис у чергу
+def setup_logging():
+    handler = logging.FileHandler(LOG_FILE, encoding='utf-8') if LOG_FILE else logging.StreamHandler()
+    if LOG_FORMAT == 'json':
+        handler.setFormatter(JsonFormatter())
+    else:
+        handler.setFormatter(logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    log_queue = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.setLevel(LOG_LEVEL)
+    for existing in root.handlers[:]:
+        root.removeHandler(existing)
+    root.addHandler(DeferredQueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    return listener
+
+log_listener = setup_logging()
 logger = logging.getLogger(__name__)
 
+# Події по кожному повідомленню (переслано, дублікат, без маршруту...) підсумовуються
+# періодично; окремо логується лише вибірка, а на рівні DEBUG — усі події
+class LogSummary:
+    def __init__(self, interval, sample_rate, sample_max):
+        self.interval = interval
+        self.sample_rate = sample_rate
+        self.sample_max = sample_max
+        self.counts = collections.Counter()
+        self.sampled = collections.Counter()
+        self.task = None
+
+    def note(self, event, msg, *args):
+        self.counts[event] += 1
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(msg, *args)
+        elif self.sampled[event] < self.sample_max and random.random() < self.sample_rate:
+            self.sampled[event] += 1
+            logger.info(msg, *args)
+
+    def flush(self):
+        if self.counts:
+            logger.info(
+                "Підсумок за %.0f с: %s",
+                self.interval,
+                ", ".join(f"{event} — {count}" for event, count in sorted(self.counts.items()))
+            )
+        self.counts.clear()
+        self.sampled.clear()
+
+    async def run(self):
+        while True:
+            await asyncio.sleep(self.interval)
+            self.flush()
+
+    def start(self):
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def stop(self):
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+            self.task = None
+        self.flush()
+
+log_summary = LogSummary(LOG_SUMMARY_INTERVAL, LOG_SAMPLE_RATE, LOG_SAMPLE_MAX)
+
 # Ініціалізація бота та клієнта Telethon
 bot = Bot(token=bot_token)
 storage = MemoryStorage()
 dp = Dispatcher(bot, storage=storage)
 dp.middleware.setup(LoggingMiddleware())
 
-client = TelegramClient('myGrab.session', api_id, api_hash, catch_up=True)
+# Сесії користувачів Telethon: канали-джерела розподіляються між ними, перша сесія — основна
+# (розпізнавання каналів, канал-приймач у меню). Кожна сесія має бути учасником або адміністратором
+# каналів-приймачів, бо пересилання за замовчуванням виконує сесія-власник каналу-джерела
+SESSIONS = getattr(config, 'SESSIONS', ['myGrab'])
+SENDER_SESSIONS = getattr(config, 'SENDER_SESSIONS', [])  # Окремий пул для пересилання, порожньо — сесія-власник
+# flood_sleep_threshold=0: Telethon не засинає на FloodWait всередині запиту, тримаючи слот обмежувача,
+# а передає кожен FloodWait обмежувачу сесії, що призупиняє всі її запити.
+# Сесії з SENDER_SESSIONS, яких немає в SESSIONS, лише пересилають і не отримують каналів-джерел
+clients = {
+    name: TelegramClient(f'{name}.session', api_id, api_hash, catch_up=True, flood_sleep_threshold=0)
+    for name in dict.fromkeys(SESSIONS + SENDER_SESSIONS)
+}
+client = clients[SESSIONS[0]]
+
+# Налаштування розподілу каналів між сесіями
+SESSION_RING_REPLICAS = getattr(config, 'SESSION_RING_REPLICAS', 100)  # Віртуальних вузлів кожної сесії на кільці
+
+# Налаштування метрик
+METRICS_PREFIX = 'tgforward'
+METRICS_PORT = getattr(config, 'METRICS_PORT', None)  # Порт локального HTTP /metrics, None — вимкнено
+METRICS_HOST = getattr(config, 'METRICS_HOST', '127.0.0.1')
+
+# Налаштування бази даних (можна перевизначити у config.py)
+DB_PATH = getattr(config, 'DB_PATH', 'channels.db')
+# Режим збереження last_message_ids:
+#   'sync' — кожне оновлення одразу комітиться (без вікна повторів після збою);
+#   'write_behind' — оновлення буферизуються і записуються однією транзакцією
+#   раз на CHECKPOINT_FLUSH_INTERVAL секунд або при CHECKPOINT_MAX_PENDING каналах у буфері.
+#   Після аварійного завершення повторно можуть бути переслані повідомлення за останній інтервал.
+CHECKPOINT_MODE = getattr(config, 'CHECKPOINT_MODE', 'write_behind')
+CHECKPOINT_FLUSH_INTERVAL = getattr(config, 'CHECKPOINT_FLUSH_INTERVAL', 1.0)
+CHECKPOINT_MAX_PENDING = getattr(config, 'CHECKPOINT_MAX_PENDING', 500)
+
+# Налаштування догонки пропущених повідомлень
+BACKFILL_PAGE_SIZE = 100  # Максимум, який повертає GetHistoryRequest за один запит
+BACKFILL_MAX_MESSAGES = getattr(config, 'BACKFILL_MAX_MESSAGES', 1000)  # На канал, 0 — без обмеження
+BACKFILL_MAX_AGE = getattr(config, 'BACKFILL_MAX_AGE', 24 * 60 * 60)  # Секунд, 0 — без обмеження
+
+CATCHUP_CONCURRENCY = getattr(config, 'CATCHUP_CONCURRENCY', 5)  # Каналів, що перевіряються одночасно
+
+# Налаштування фонового пошуку пропусків під час роботи
+GAP_CHECK_ENABLED = getattr(config, 'GAP_CHECK_ENABLED', True)
+GAP_CHECK_MIN_INTERVAL = getattr(config, 'GAP_CHECK_MIN_INTERVAL', 60)  # Секунд між перевірками активного каналу
+GAP_CHECK_MAX_INTERVAL = getattr(config, 'GAP_CHECK_MAX_INTERVAL', 30 * 60)  # Секунд між перевірками неактивного каналу
+GAP_CHECK_RATE = getattr(config, 'GAP_CHECK_RATE', 0.2)  # Запитів на секунду для всіх перевірок разом
+GAP_CHECK_BURST = getattr(config, 'GAP_CHECK_BURST', 3)
+GAP_CHECK_BATCH = 100  # Каналів в одному GetPeerDialogsRequest
+GAP_CHECK_GRACE = getattr(config, 'GAP_CHECK_GRACE', 30)  # Секунд, протягом яких нове повідомлення ще чекає на живе оновлення
+GAP_CHECK_TICK = 5  # Секунд між проходами планувальника
+
+# Налаштування пакетного пересилання
+FORWARD_BATCH_SIZE = 100  # Максимум ID повідомлень в одному запиті пересилання
+ALBUM_MAX_SIZE = 10  # Максимальна кількість елементів в альбомі Telegram
+FORWARD_BATCH_WINDOW = getattr(config, 'FORWARD_BATCH_WINDOW', 0.5)  # Секунд накопичення пакета
+
+# Налаштування розпізнавання каналів при масовому додаванні
+RESOLVE_CONCURRENCY = getattr(config, 'RESOLVE_CONCURRENCY', 4)  # Одночасних запитів get_entity
+RESOLVE_RATE = getattr(config, 'RESOLVE_RATE', 2.0)  # Запитів на секунду
+RESOLVE_BURST = getattr(config, 'RESOLVE_BURST', 5)
+RESOLVE_RETRIES = getattr(config, 'RESOLVE_RETRIES', 3)
+ENTITY_USERNAME_TTL = getattr(config, 'ENTITY_USERNAME_TTL', 7 * 24 * 60 * 60)  # Секунд, після яких username з кешу розпізнається знову
+PROGRESS_EDIT_INTERVAL = getattr(config, 'PROGRESS_EDIT_INTERVAL', 3.0)  # Секунд між оновленнями повідомлення про прогрес
+CHANNELS_PAGE_SIZE = getattr(config, 'CHANNELS_PAGE_SIZE', 20)  # Каналів на одній сторінці списку в боті
+
+# Налаштування імпорту та експорту
+IMPORT_DIR = getattr(config, 'IMPORT_DIR', 'imports')  # Каталог для завантажених файлів імпорту
+IMPORT_BATCH_SIZE = getattr(config, 'IMPORT_BATCH_SIZE', 100)  # Рядків файлу в одній транзакції
+EXPORT_CHUNK_SIZE = getattr(config, 'EXPORT_CHUNK_SIZE', 500)  # Рядків бази даних за одне читання під час експорту
+
+# Налаштування черги пересилання
+QUEUE_WORKERS = getattr(config, 'QUEUE_WORKERS', 4)  # Одночасних пересилань з різних смуг
+QUEUE_POLL_INTERVAL = getattr(config, 'QUEUE_POLL_INTERVAL', 5.0)  # Секунд між страхувальними перевірками черги
+QUEUE_RETRY_BASE = getattr(config, 'QUEUE_RETRY_BASE', 30.0)  # Секунд до першого повтору з черги
+QUEUE_RETRY_MAX = getattr(config, 'QUEUE_RETRY_MAX', 3600.0)
+QUEUE_MAX_ATTEMPTS = getattr(config, 'QUEUE_MAX_ATTEMPTS', 10)  # Після цього рядок видаляється з черги
+
+# Налаштування обмеження швидкості пересилання
+FORWARD_CONCURRENCY = getattr(config, 'FORWARD_CONCURRENCY', 5)  # Одночасних запитів
+FORWARD_GLOBAL_RATE = getattr(config, 'FORWARD_GLOBAL_RATE', 5.0)  # Запитів на секунду загалом
+FORWARD_GLOBAL_BURST = getattr(config, 'FORWARD_GLOBAL_BURST', 10)
+FORWARD_CHAT_RATE = getattr(config, 'FORWARD_CHAT_RATE', 0.5)  # Запитів на секунду в один канал-приймач
+FORWARD_CHAT_BURST = getattr(config, 'FORWARD_CHAT_BURST', 3)
+FORWARD_RETRIES = getattr(config, 'FORWARD_RETRIES', 5)  # Спроб для тимчасових помилок
+FORWARD_BACKOFF_BASE = getattr(config, 'FORWARD_BACKOFF_BASE', 1.0)
+FORWARD_BACKOFF_MAX = getattr(config, 'FORWARD_BACKOFF_MAX', 60.0)
+FLOOD_WAIT_MAX = getattr(config, 'FLOOD_WAIT_MAX', 900)  # Довше очікування вважається невдачею
+FLOOD_WAIT_RETRIES = getattr(config, 'FLOOD_WAIT_RETRIES', 10)  # Коротких FloodWait на один запит, далі — невдача
+
+# Налаштування дедуплікації повідомлень з різних каналів
+DEDUP_ENABLED = getattr(config, 'DEDUP_ENABLED', True)
+DEDUP_WINDOW = getattr(config, 'DEDUP_WINDOW', 24 * 60 * 60)  # Секунд, протягом яких повтор вважається дублікатом
+DEDUP_LRU_SIZE = getattr(config, 'DEDUP_LRU_SIZE', 100000)  # Відбитків у точному LRU-кеші
+DEDUP_CAPACITY = getattr(config, 'DEDUP_CAPACITY', 2000000)  # Відбитків на одне покоління фільтра Блума
+DEDUP_ERROR_RATE = getattr(config, 'DEDUP_ERROR_RATE', 1e-6)  # Ймовірність хибного дубліката
+DEDUP_PRUNE_INTERVAL = getattr(config, 'DEDUP_PRUNE_INTERVAL', 10 * 60)  # Секунд між очищеннями таблиці fingerprints
+
+# Налаштування копіювання повідомлень (режим правила 'copy')
+DELIVERY_MODE = getattr(config, 'DELIVERY_MODE', 'forward')  # Режим основного каналу-приймача: 'forward' або 'copy'
+COPY_CHUNK_SIZE = getattr(config, 'COPY_CHUNK_SIZE', 512 * 1024)  # Байт за один запит завантаження та вивантаження
+COPY_SPOOL_MAX = getattr(config, 'COPY_SPOOL_MAX', 8 * 1024 * 1024)  # Байт медіа в пам'яті, більші файли — на диску
+MEDIA_CACHE_RETENTION = getattr(config, 'MEDIA_CACHE_RETENTION', 30 * 24 * 60 * 60)  # Секунд зберігання посилань на медіа, 0 — без обмеження
+MEDIA_CACHE_PRUNE_INTERVAL = getattr(config, 'MEDIA_CACHE_PRUNE_INTERVAL', 6 * 60 * 60)  # Секунд між очищеннями кешу медіа
+
+# Налаштування архіву пересланих повідомлень
+ARCHIVE_ENABLED = getattr(config, 'ARCHIVE_ENABLED', True)
+ARCHIVE_RETENTION = getattr(config, 'ARCHIVE_RETENTION', 90 * 24 * 60 * 60)  # Секунд зберігання, 0 — без обмеження
+ARCHIVE_PRUNE_INTERVAL = getattr(config, 'ARCHIVE_PRUNE_INTERVAL', 6 * 60 * 60)  # Секунд між очищеннями та стисненням індексу
+ARCHIVE_PRUNE_CHUNK = getattr(config, 'ARCHIVE_PRUNE_CHUNK', 1000)  # Рядків, що видаляються за одну транзакцію
+ARCHIVE_PAGE_SIZE = getattr(config, 'ARCHIVE_PAGE_SIZE', 10)  # Результатів /search на сторінці
+
+# Метрики конвеєра пересилання: лічильники та гістограми затримок з фіксованими
+# кошиками. Оновлення — лише операції зі словниками в пам'яті, без блокувань і I/O
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600)
+
+# Назва мітки для метрик, що мають мітку
+METRIC_LABELS = {
+    'stage_seconds': 'stage',
+    'forward_attempts_total': 'result',
+    'forward_errors_total': 'error',
+    'forwarded_total': 'source',
+    'skipped_total': 'reason',
+    'source_end_to_end_seconds': 'source',
+}
+# Гістограми з міткою каналу експортуються лише як сума та кількість, щоб не множити ряди
+SUMMARY_ONLY_METRICS = {'source_end_to_end_seconds'}
+
+class Histogram:
+    __slots__ = ('counts', 'sum', 'count')
+
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(LATENCY_BUCKETS, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    # Оцінка квантиля: верхня межа кошика, в який він потрапляє
+    def quantile(self, q):
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        total = 0
+        for index, count in enumerate(self.counts):
+            total += count
+            if total >= rank:
+                return LATENCY_BUCKETS[index] if index < len(LATENCY_BUCKETS) else float('inf')
+        return float('inf')
+
+class Metrics:
+    def __init__(self):
+        self.counters = collections.Counter()  # (назва, мітка) -> значення
+        self.histograms = {}  # (назва, мітка) -> Histogram
+
+    def inc(self, name, label=None, value=1):
+        self.counters[name, label] += value
+
+    def observe(self, name, value, label=None):
+        histogram = self.histograms.get((name, label))
+        if histogram is None:
+            histogram = self.histograms[name, label] = Histogram()
+        histogram.observe(value)
+
+    def counter(self, name, label=None):
+        return self.counters.get((name, label), 0)
+
+    def histogram(self, name, label=None):
+        return self.histograms.get((name, label)) or Histogram()
+
+    # Текстовий формат Prometheus
+    def render_prometheus(self):
+        lines = []
+        for name in sorted({name for name, _ in self.counters}):
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} counter")
+            for (counter_name, label), value in self.counters.items():
+                if counter_name == name:
+                    lines.append(f"{METRICS_PREFIX}_{name}{self.format_labels(name, label)} {value}")
+        for name in sorted({name for name, _ in self.histograms}):
+            summary_only = name in SUMMARY_ONLY_METRICS
+            lines.append(f"# TYPE {METRICS_PREFIX}_{name} {'summary' if summary_only else 'histogram'}")
+            for (histogram_name, label), histogram in self.histograms.items():
+                if histogram_name != name:
+                    continue
+                if not summary_only:
+                    cumulative = 0
+                    for bound, count in zip(LATENCY_BUCKETS + ('+Inf',), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{METRICS_PREFIX}_{name}_bucket{self.format_labels(name, label, le=bound)} {cumulative}")
+                lines.append(f"{METRICS_PREFIX}_{name}_sum{self.format_labels(name, label)} {histogram.sum}")
+                lines.append(f"{METRICS_PREFIX}_{name}_count{self.format_labels(name, label)} {histogram.count}")
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def format_labels(name, label, le=None):
+        pairs = []
+        if label is not None:
+            pairs.append(f'{METRIC_LABELS.get(name, "label")}="{label}"')
+        if le is not None:
+            pairs.append(f'le="{le}"')
+        return '{' + ','.join(pairs) + '}' if pairs else ''
+
+metrics = Metrics()
+metrics_runner = None
+
+# Локальний HTTP-сервер з ендпоінтом /metrics у форматі Prometheus
+async def start_metrics_server():
+    global metrics_runner
+    if not METRICS_PORT:
+        return
+    from aiohttp import web
+
+    async def handle_metrics(request):
+        return web.Response(text=metrics.render_prometheus(), content_type='text/plain', charset='utf-8')
+
+    app = web.Application()
+    app.router.add_get('/metrics', handle_metrics)
+    metrics_runner = web.AppRunner(app)
+    await metrics_runner.setup()
+    await web.TCPSite(metrics_runner, METRICS_HOST, METRICS_PORT).start()
+    logger.info(f"Метрики доступні на http://{METRICS_HOST}:{METRICS_PORT}/metrics")
+
+async def stop_metrics_server():
+    global metrics_runner
+    if metrics_runner:
+        await metrics_runner.cleanup()
+        metrics_runner = None
+
+# Спільне з'єднання з базою даних, відкривається в init_db
+db_connection = None
+db_lock = asyncio.Lock()  # Серіалізація транзакцій запису на спільному з'єднанні
+
+# last_message_ids в пам'яті (channel_id -> last_id), щоб перевірка в обробнику не чекала на диск
+last_message_ids = {}
+# Буфер відкладеного запису last_message_ids: channel_id -> last_id
+pending_last_ids = {}
+# Фонове завдання відкладеного запису (last_message_ids та відбитки повідомлень)
+write_behind_event = asyncio.Event()
+write_behind_task = None
+
+# Кеш маршрутизації в пам'яті: event.chat_id -> ID каналу в базі даних та канал-приймач
+monitored_channels = {}
+destination_channel_id = None
+
+# Приведення збереженого ID каналу до формату event.chat_id (-100...)
+def to_peer_id(channel_id):
+    if channel_id < 0:
+        return channel_id
+    return utils.get_peer_id(PeerChannel(channel_id))
+
+# PeerChannel для збереженого ID каналу (як у форматі -100..., так і без нього)
+def to_channel_peer(channel_id):
+    if channel_id < 0:
+        return PeerChannel(utils.resolve_id(channel_id)[0])
+    return PeerChannel(channel_id)
+
+# Отримання спільного з'єднання з базою даних
+async def get_db():
+    global db_connection
+    if db_connection is None:
+        db_connection = await aiosqlite.connect(DB_PATH)
+        await db_connection.execute('PRAGMA journal_mode=WAL')
+        await db_connection.execute('PRAGMA synchronous=NORMAL')
+        logger.info(f"Відкрито з'єднання з базою даних {DB_PATH} (WAL).")
+    return db_connection
+
+# Завантаження кешу маршрутизації з бази даних
+async def load_routing_cache():
+    global monitored_channels, destination_channel_id
+    db = await get_db()
+    cursor = await db.execute('SELECT id FROM channels')
+    rows = await cursor.fetchall()
+    cursor = await db.execute('SELECT id FROM destination LIMIT 1')
+    destination_row = await cursor.fetchone()
+    cursor = await db.execute('SELECT channel_id, last_id FROM last_message_ids')
+    checkpoints = dict(await cursor.fetchall())
+    cursor = await db.execute('SELECT channel_id, session FROM channel_sessions')
+    sessions = dict(await cursor.fetchall())
+    # Ще не записані значення з буфера новіші за збережені на диску
+    checkpoints.update(pending_last_ids)
+    last_message_ids.clear()
+    last_message_ids.update(checkpoints)
+    # Заміна цілими об'єктами, щоб обробник ніколи не бачив напівоновлений кеш
+    monitored_channels = {to_peer_id(row[0]): row[0] for row in rows}
+    channel_sessions.clear()
+    channel_sessions.update(sessions)
+    destination_channel_id = destination_row[0] if destination_row else None
+    await load_routes()
+    schedule_message_handler_refresh()
+    logger.info(f"Кеш маршрутизації завантажено: {len(monitored_channels)} каналів.")
+
+# Додавання стовпця до наявної таблиці, якщо його ще немає
+async def add_column(db, table, column, definition):
+    cursor = await db.execute(f'PRAGMA table_info({table})')
+    if column not in [row[1] for row in await cursor.fetchall()]:
+        await db.execute(f'ALTER TABLE {table} ADD COLUMN {column} {definition}')
+        logger.info(f"До таблиці {table} додано стовпець {column}.")
 
 # Функція для створення бази даних та таблиць
 async def init_db():
-    async with aiosqlite.connect('channels.db') as db:
+    global write_behind_task
+    db = await get_db()
+    async with db_lock:
+        cursor = await db.execute("SELECT 1 FROM sqlite_master WHERE name = 'channels_fts'")
+        channels_fts_exists = await cursor.fetchone() is not None
         await db.execute('''
             CREATE TABLE IF NOT EXISTS channels (
                 id INTEGER PRIMARY KEY,
@@ -59,25 +472,246 @@ async def init_db():
                 last_id INTEGER
             )
         ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS forward_queue (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                destination_id INTEGER NOT NULL,
+                grouped_id INTEGER,
+                message_date REAL,
+                enqueued_at REAL NOT NULL,
+                attempts INTEGER NOT NULL DEFAULT 0,
+                next_attempt_at REAL NOT NULL DEFAULT 0,
+                mode TEXT NOT NULL DEFAULT 'forward',
+                fingerprint INTEGER,
+                UNIQUE (source_id, message_id, destination_id)
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS forward_queue_lane ON forward_queue (source_id, destination_id, message_id)')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS entities (
+                id INTEGER PRIMARY KEY,
+                username TEXT COLLATE NOCASE,
+                access_hash INTEGER,
+                title TEXT,
+                type TEXT,
+                updated_at REAL
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS entities_username ON entities (username)')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS fingerprints (
+                fingerprint INTEGER PRIMARY KEY,
+                seen_at REAL NOT NULL
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS fingerprints_seen_at ON fingerprints (seen_at)')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS routes (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                destination_id INTEGER NOT NULL,
+                include_keywords TEXT NOT NULL DEFAULT '',
+                exclude_keywords TEXT NOT NULL DEFAULT '',
+                regex TEXT NOT NULL DEFAULT '',
+                media_types TEXT NOT NULL DEFAULT '',
+                mode TEXT NOT NULL DEFAULT 'forward'
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS route_sources (
+                route_id INTEGER NOT NULL,
+                source_id INTEGER NOT NULL,
+                PRIMARY KEY (route_id, source_id)
+            )
+        ''')
+        # Повнотекстовий індекс назв каналів для пошуку, синхронізується тригерами
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS channels_fts USING fts5(title, content='channels', content_rowid='id')
+        """)
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS channels_fts_insert AFTER INSERT ON channels BEGIN
+                INSERT INTO channels_fts (rowid, title) VALUES (new.id, new.title);
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS channels_fts_delete AFTER DELETE ON channels BEGIN
+                INSERT INTO channels_fts (channels_fts, rowid, title) VALUES ('delete', old.id, old.title);
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS channels_fts_update AFTER UPDATE OF title ON channels BEGIN
+                INSERT INTO channels_fts (channels_fts, rowid, title) VALUES ('delete', old.id, old.title);
+                INSERT INTO channels_fts (rowid, title) VALUES (new.id, new.title);
+            END
+        ''')
+        if not channels_fts_exists:
+            # Індексація каналів, доданих до появи індексу
+            await db.execute("INSERT INTO channels_fts (channels_fts) VALUES ('rebuild')")
+        # Кеш медіа, вже надісланих копією: повторне надсилання за посиланням без завантаження
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS media_cache (
+                session TEXT NOT NULL,
+                source_key TEXT NOT NULL,
+                kind TEXT NOT NULL,
+                media_id INTEGER NOT NULL,
+                access_hash INTEGER NOT NULL,
+                file_reference BLOB NOT NULL,
+                updated_at REAL NOT NULL,
+                PRIMARY KEY (session, source_key)
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS media_cache_updated ON media_cache (updated_at)')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS archive (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                source_id INTEGER NOT NULL,
+                message_id INTEGER NOT NULL,
+                destination_id INTEGER NOT NULL,
+                destination_message_id INTEGER,
+                message_date REAL NOT NULL,
+                media_type TEXT NOT NULL,
+                text TEXT NOT NULL DEFAULT ''
+            )
+        ''')
+        await db.execute('CREATE INDEX IF NOT EXISTS archive_message_date ON archive (message_date)')
+        await db.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS archive_fts USING fts5(text, content='archive', content_rowid='id')
+        """)
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS archive_fts_insert AFTER INSERT ON archive BEGIN
+                INSERT INTO archive_fts (rowid, text) VALUES (new.id, new.text);
+            END
+        ''')
+        await db.execute('''
+            CREATE TRIGGER IF NOT EXISTS archive_fts_delete AFTER DELETE ON archive BEGIN
+                INSERT INTO archive_fts (archive_fts, rowid, text) VALUES ('delete', old.id, old.text);
+            END
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS import_jobs (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                chat_id INTEGER NOT NULL,
+                file_path TEXT NOT NULL,
+                file_name TEXT NOT NULL,
+                format TEXT NOT NULL,
+                columns TEXT NOT NULL DEFAULT '',
+                file_size INTEGER NOT NULL DEFAULT 0,
+                position INTEGER NOT NULL DEFAULT 0,
+                added INTEGER NOT NULL DEFAULT 0,
+                failed INTEGER NOT NULL DEFAULT 0,
+                status TEXT NOT NULL DEFAULT 'running',
+                updated_at REAL NOT NULL
+            )
+        ''')
+        await db.execute('''
+            CREATE TABLE IF NOT EXISTS channel_sessions (
+                channel_id INTEGER PRIMARY KEY,
+                session TEXT NOT NULL
+            )
+        ''')
+        # Міграція баз даних, створених до появи режиму копіювання
+        await add_column(db, 'routes', 'mode', "TEXT NOT NULL DEFAULT 'forward'")
+        await add_column(db, 'forward_queue', 'mode', "TEXT NOT NULL DEFAULT 'forward'")
+        await add_column(db, 'forward_queue', 'fingerprint', 'INTEGER')
         await db.commit()
     logger.info("База даних ініціалізована.")
+    await load_routing_cache()
+    # Канали сесій, прибраних з конфігурації, та канали без сесії отримують нового власника
+    await rebalance_channels()
+
+    await load_fingerprints()
+
+    if write_behind_task is None:
+        write_behind_task = asyncio.create_task(write_behind_flusher())
+
+# Закриття бази даних із записом буферів відкладеного запису
+async def close_db():
+    global db_connection, write_behind_task
+    if write_behind_task is not None:
+        write_behind_task.cancel()
+        write_behind_task = None
+    if db_connection is None:
+        return
+    await flush_pending_writes()
+    await db_connection.close()
+    db_connection = None
+    logger.info("З'єднання з базою даних закрито.")
 
 # Функції для роботи з базою даних
 async def save_channel(channel_id, channel_title):
-    async with aiosqlite.connect('channels.db') as db:
+    session = get_channel_session(channel_id)
+    db = await get_db()
+    async with db_lock:
         await db.execute('INSERT OR IGNORE INTO channels (id, title) VALUES (?, ?)', (channel_id, channel_title))
+        await db.execute('INSERT OR REPLACE INTO channel_sessions (channel_id, session) VALUES (?, ?)', (channel_id, session))
         await db.commit()
+    channel_sessions[channel_id] = session
+    monitored_channels[to_peer_id(channel_id)] = channel_id
+    schedule_message_handler_refresh()
     logger.info(f"Канал {channel_title} (ID: {channel_id}) збережено у базі даних.")
 
+# Збереження багатьох каналів та їхніх last_message_id однією транзакцією
+# progress — (ID завдання імпорту, позиція у файлі, додано, помилок): записується в тій самій транзакції,
+# тому перерваний імпорт продовжується рівно з першого незбереженого пакета
+# Повертає кількість справді нових каналів: вже збережені INSERT OR IGNORE пропускає
+async def save_channels_bulk(channels, last_ids, progress=None):
+    sessions = {channel_id: get_channel_session(channel_id) for channel_id, _ in channels}
+    db = await get_db()
+    async with db_lock:
+        cursor = await db.executemany('INSERT OR IGNORE INTO channels (id, title) VALUES (?, ?)', channels)
+        added = max(cursor.rowcount, 0)
+        await db.executemany('INSERT OR REPLACE INTO channel_sessions (channel_id, session) VALUES (?, ?)', list(sessions.items()))
+        await db.executemany('INSERT OR REPLACE INTO last_message_ids (channel_id, last_id) VALUES (?, ?)', list(last_ids.items()))
+        if progress:
+            job_id, position, failed = progress
+            await db.execute(
+                'UPDATE import_jobs SET position = ?, added = added + ?, failed = failed + ?, updated_at = ? WHERE id = ?',
+                (position, added, failed, time.time(), job_id)
+            )
+        await db.commit()
+    channel_sessions.update(sessions)
+    for channel_id, _ in channels:
+        monitored_channels[to_peer_id(channel_id)] = channel_id
+    for channel_id, last_id in last_ids.items():
+        pending_last_ids.pop(channel_id, None)
+        last_message_ids[channel_id] = last_id
+    schedule_message_handler_refresh()
+    queue_sender_joins(channel_id for channel_id, _ in channels)
+    logger.info(f"Збережено {len(channels)} каналів у базі даних, нових: {added}.")
+    return added
+
 async def delete_channel(channel_id):
-    async with aiosqlite.connect('channels.db') as db:
+    db = await get_db()
+    async with db_lock:
+        pending_last_ids.pop(channel_id, None)
+        last_message_ids.pop(channel_id, None)
         await db.execute('DELETE FROM channels WHERE id = ?', (channel_id,))
         await db.execute('DELETE FROM last_message_ids WHERE channel_id = ?', (channel_id,))
+        await db.execute('DELETE FROM forward_queue WHERE source_id = ?', (channel_id,))
+        await db.execute('DELETE FROM channel_sessions WHERE channel_id = ?', (channel_id,))
+        # Джерело в правилах може бути збережене в будь-якому з двох форматів ID
+        source_ids = (to_peer_id(channel_id), to_channel_peer(channel_id).channel_id)
+        cursor = await db.execute('SELECT DISTINCT route_id FROM route_sources WHERE source_id IN (?, ?)', source_ids)
+        route_ids = [row[0] for row in await cursor.fetchall()]
+        await db.execute('DELETE FROM route_sources WHERE source_id IN (?, ?)', source_ids)
+        # Правило без джерел діяло б для всіх каналів, тому правила лише цього каналу видаляються
+        for route_id in route_ids:
+            await db.execute(
+                'DELETE FROM routes WHERE id = ? AND NOT EXISTS (SELECT 1 FROM route_sources WHERE route_id = ?)', (route_id, route_id)
+            )
         await db.commit()
+    channel_sessions.pop(channel_id, None)
+    monitored_channels.pop(to_peer_id(channel_id), None)
+    schedule_message_handler_refresh()
+    if route_ids:
+        await load_routes()
     logger.info(f"Канал з ID {channel_id} видалено з бази даних.")
 
 async def set_destination_channel(channel_id):
-    async with aiosqlite.connect('channels.db') as db:
+    global destination_channel_id
+    db = await get_db()
+    async with db_lock:
         await db.execute('DELETE FROM destination')  # Видалення попереднього каналу-приймача
         if channel_id:
             await db.execute('INSERT INTO destination (id) VALUES (?)', (channel_id,))
@@ -85,101 +719,1929 @@ async def set_destination_channel(channel_id):
         else:
             logger.info("Канал-приймач видалено.")
         await db.commit()
+    destination_channel_id = channel_id or None
+    await load_routes()
 
 async def get_destination_channel():
-    async with aiosqlite.connect('channels.db') as db:
-        cursor = await db.execute('SELECT id FROM destination LIMIT 1')
-        row = await cursor.fetchone()
-        return row[0] if row else None
+    return destination_channel_id
 
 async def get_channels():
-    async with aiosqlite.connect('channels.db') as db:
-        cursor = await db.execute('SELECT id, title FROM channels')
-        channels = await cursor.fetchall()
-    logger.info(f"Отримано {len(channels)} каналів для моніторингу.")
+    db = await get_db()
+    cursor = await db.execute('SELECT id, title FROM channels')
+    channels = await cursor.fetchall()
+    logger.debug("Отримано %d каналів для моніторингу.", len(channels))
     return channels
 
+# Запит FTS5 з тексту користувача: кожне слово — префікс, усі слова мають збігтися
+def channel_search_query(text):
+    words = re.findall(r'\w+', text)
+    return ' '.join(f'"{word}"*' for word in words) if words else None
+
+# Сторінка каналів за ключем: after — сторінка після ID, before — сторінка перед ID.
+# search — запит channel_search_query. Повертає (канали, чи є попередня сторінка, чи є наступна)
+async def get_channels_page(after=None, before=None, search=None, limit=CHANNELS_PAGE_SIZE):
+    source = 'channels'
+    conditions = []
+    params = []
+    if search:
+        source = 'channels_fts JOIN channels ON channels.id = channels_fts.rowid'
+        conditions.append('channels_fts MATCH ?')
+        params.append(search)
+    if before is not None:
+        conditions.append('channels.id < ?')
+        params.append(before)
+    elif after is not None:
+        conditions.append('channels.id > ?')
+        params.append(after)
+    where = f"WHERE {' AND '.join(conditions)}" if conditions else ''
+    order = 'DESC' if before is not None else 'ASC'
+    db = await get_db()
+    cursor = await db.execute(
+        f'SELECT channels.id, channels.title FROM {source} {where} ORDER BY channels.id {order} LIMIT ?',
+        (*params, limit + 1)
+    )
+    rows = await cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if before is not None:
+        rows.reverse()
+        return rows, more, True
+    return rows, after is not None, more
+
+# Кількість каналів (або збігів пошуку) без завантаження рядків
+async def count_channels(search=None):
+    db = await get_db()
+    if search:
+        cursor = await db.execute('SELECT COUNT(*) FROM channels_fts WHERE channels_fts MATCH ?', (search,))
+    else:
+        cursor = await db.execute('SELECT COUNT(*) FROM channels')
+    row = await cursor.fetchone()
+    return row[0]
+
 async def get_last_message_id(channel_id):
-    async with aiosqlite.connect('channels.db') as db:
-        cursor = await db.execute('SELECT last_id FROM last_message_ids WHERE channel_id = ?', (channel_id,))
-        row = await cursor.fetchone()
-        return row[0] if row else 0
+    return last_message_ids.get(channel_id, 0)
 
 async def update_last_message_id(channel_id, last_id):
-    async with aiosqlite.connect('channels.db') as db:
-        await db.execute('INSERT OR REPLACE INTO last_message_ids (channel_id, last_id) VALUES (?, ?)', (channel_id, last_id))
+    last_message_ids[channel_id] = last_id
+    if CHECKPOINT_MODE == 'write_behind':
+        pending_last_ids[channel_id] = last_id
+        if len(pending_last_ids) >= CHECKPOINT_MAX_PENDING:
+            write_behind_event.set()
+    else:
+        db = await get_db()
+        started = time.perf_counter()
+        async with db_lock:
+            await db.execute('INSERT OR REPLACE INTO last_message_ids (channel_id, last_id) VALUES (?, ?)', (channel_id, last_id))
+            await db.commit()
+        metrics.observe('stage_seconds', time.perf_counter() - started, 'checkpoint')
+        metrics.inc('checkpoint_writes_total')
+    log_summary.note('checkpoint', "last_message_id для каналу %s оновлено до %s.", channel_id, last_id)
+
+# Запис буфера last_message_ids однією транзакцією
+async def flush_last_message_ids():
+    if not pending_last_ids:
+        return
+    started = time.perf_counter()
+    db = await get_db()
+    async with db_lock:
+        # Знімок береться під блокуванням, щоб не записати канал, видалений під час очікування
+        rows = list(pending_last_ids.items())
+        pending_last_ids.clear()
+        try:
+            await db.executemany('INSERT OR REPLACE INTO last_message_ids (channel_id, last_id) VALUES (?, ?)', rows)
+            await db.commit()
+        except BaseException:
+            # Повернення незаписаних значень, якщо їх ще не замінено новішими
+            for channel_id, last_id in rows:
+                pending_last_ids.setdefault(channel_id, last_id)
+            raise
+    metrics.observe('stage_seconds', time.perf_counter() - started, 'checkpoint')
+    metrics.inc('checkpoint_writes_total', value=len(rows))
+    logger.debug("Записано last_message_id для %d каналів.", len(rows))
+
+# Запис усіх буферів відкладеного запису
+async def flush_pending_writes():
+    await flush_last_message_ids()
+    await flush_fingerprints()
+    await flush_archive()
+    await prune_media_cache()
+
+# Фонове завдання відкладеного запису
+async def write_behind_flusher():
+    while True:
+        try:
+            await asyncio.wait_for(write_behind_event.wait(), CHECKPOINT_FLUSH_INTERVAL)
+        except asyncio.TimeoutError:
+            pass
+        write_behind_event.clear()
+        try:
+            await flush_pending_writes()
+        except Exception as e:
+            logger.error(f"Помилка при відкладеному записі в базу даних: {str(e)}", exc_info=True)
+
+# Консистентне хешування: кожна сесія займає SESSION_RING_REPLICAS точок на кільці,
+# тому додавання чи вилучення сесії переносить лише її частку каналів
+class HashRing:
+    def __init__(self, nodes, replicas):
+        self.nodes = list(nodes)
+        self.points = sorted((ring_hash(f"{node}#{replica}"), node) for node in self.nodes for replica in range(replicas))
+        self.keys = [point for point, _ in self.points]
+
+    def get(self, key):
+        if not self.points:
+            return None
+        index = bisect.bisect(self.keys, ring_hash(str(key))) % len(self.points)
+        return self.points[index][1]
+
+def ring_hash(value):
+    return int.from_bytes(hashlib.blake2b(value.encode(), digest_size=8).digest(), 'big')
+
+# Сесія-власник кожного каналу: збережений ID каналу -> назва сесії (дзеркало таблиці channel_sessions)
+channel_sessions = {}
+session_banned_until = {}  # Назва сесії -> time.monotonic(), до якого вона виведена з кільця через FloodWait
+session_ring = HashRing(SESSIONS, SESSION_RING_REPLICAS)
+sender_ring = HashRing(SENDER_SESSIONS, SESSION_RING_REPLICAS)
+pending_joins = set()  # (збережений ID каналу, сесія), що має до нього приєднатися
+join_event = asyncio.Event()
+join_task = None
+
+def available_sessions(names):
+    now = time.monotonic()
+    return [name for name in names if session_banned_until.get(name, 0) <= now]
+
+# Кільця перебудовуються лише з доступних сесій; якщо заблоковані всі, лишаються всі
+def rebuild_session_rings():
+    global session_ring, sender_ring
+    session_ring = HashRing(available_sessions(SESSIONS) or SESSIONS, SESSION_RING_REPLICAS)
+    sender_ring = HashRing(available_sessions(SENDER_SESSIONS) or SENDER_SESSIONS, SESSION_RING_REPLICAS)
+
+# Ключ кільця — позначений ID, щоб канал, збережений як числом, так і через username, мав одного власника
+def get_channel_session(channel_id):
+    session = channel_sessions.get(channel_id)
+    if session is None or session not in clients:
+        session = session_ring.get(to_peer_id(channel_id))
+    return session
+
+def get_channel_client(channel_id):
+    return clients[get_channel_session(channel_id)]
+
+# Сесія, що пересилає повідомлення каналу: з пулу SENDER_SESSIONS або сесія-власник.
+# Вибір за каналом-джерелом зберігає порядок пересилання в межах смуги
+def get_sender_session(source_id):
+    if SENDER_SESSIONS:
+        return sender_ring.get(to_peer_id(source_id))
+    return get_channel_session(source_id)
+
+# Сесія-відправник, що не є власником, теж вступає до каналу-джерела: без access_hash каналу
+# вона не може пересилати з нього повідомлення
+def queue_sender_joins(channel_ids):
+    if len(clients) == 1:
+        return
+    for channel_id in channel_ids:
+        sender = get_sender_session(channel_id)
+        if sender != get_channel_session(channel_id):
+            pending_joins.add((channel_id, sender))
+    join_event.set()
+
+# InputPeerChannel каналу для сесії. access_hash у кеші entities отримано основною сесією,
+# тому для неї канал знаходиться навіть з холодним кешем сутностей Telethon;
+# інші сесії використовують власний кеш Telethon, заповнений при вступі до каналу
+input_peers = {}  # (сесія, channel_id) -> InputPeerChannel
+
+async def get_input_channel(channel_id, session=None):
+    session = session or get_channel_session(channel_id)
+    peer = input_peers.get((session, channel_id))
+    if peer is None:
+        cached = await get_cached_entity(channel_id) if clients[session] is client else None
+        if cached and cached.access_hash is not None:
+            peer = InputPeerChannel(cached.id, cached.access_hash)
+        else:
+            peer = await clients[session].get_input_entity(to_channel_peer(channel_id))
+        input_peers[session, channel_id] = peer
+    return peer
+
+# Пересилання з каналу-джерела від імені сесії-відправника
+async def forward_from_source(sender, session, source_id, destination, message_ids):
+    from_peer = await get_input_channel(source_id, session)
+    return await sender.forward_messages(destination, message_ids, from_peer=from_peer)
+
+# Вступ сесії до каналу: оновлення надходять лише з каналів, учасником яких є сесія.
+# access_hash каналу в кожного акаунта свій, тому сесія спочатку сама розпізнає канал за username
+# з кешу entities. Запити йдуть через обмежувач сесії, щоб масовий перерозподіл не викликав FloodWait.
+# З однією сесією канали, як і раніше, підписуються вручну
+async def join_channel(session, channel_id, username=None):
+    if len(clients) == 1:
+        return
+    if username is None:
+        cached = await get_cached_entity(channel_id)
+        username = cached.username if cached else None
+    session_client = clients[session]
+    try:
+        async with rate_limiters[session].slot('join'):
+            if username:
+                peer = utils.get_input_peer(await session_client.get_entity(username))
+                input_peers[session, channel_id] = peer
+            else:
+                # Без username канал можна знайти лише в кеші сутностей самої сесії
+                peer = await get_input_channel(channel_id, session)
+        async with rate_limiters[session].slot('join'):
+            await session_client(JoinChannelRequest(peer))
+        logger.info(f"Сесія {session} приєдналася до каналу {channel_id}.")
+    except errors.FloodWaitError as e:
+        rate_limiters[session].report_flood_wait(e.seconds)
+        # Вступ повториться, коли обмежувач сесії дочекається кінця FloodWait
+        pending_joins.add((channel_id, session))
+        join_event.set()
+    except (errors.UsernameNotOccupiedError, errors.UsernameInvalidError) as e:
+        await forget_cached_username(username)
+        logger.warning(f"Сесія {session} не змогла приєднатися до каналу {channel_id}: {e}")
+    except Exception as e:
+        logger.warning(f"Сесія {session} не змогла приєднатися до каналу {channel_id}: {e}")
+
+# Призначення сесій каналам за поточним кільцем; переносяться лише канали, власник яких змінився
+async def rebalance_channels():
+    rebuild_session_rings()
+    moved = {}
+    for channel_id in monitored_channels.values():
+        session = session_ring.get(to_peer_id(channel_id))
+        if channel_sessions.get(channel_id) != session:
+            moved[channel_id] = session
+    # Кільце відправників теж могло змінитися; канали, які сесія вже знає, приєднувач пропускає
+    queue_sender_joins(monitored_channels.values())
+    if not moved:
+        return moved
+    db = await get_db()
+    async with db_lock:
+        await db.executemany('INSERT OR REPLACE INTO channel_sessions (channel_id, session) VALUES (?, ?)', list(moved.items()))
+        await db.commit()
+    channel_sessions.update(moved)
+    metrics.inc('session_moves_total', value=len(moved))
+    schedule_message_handler_refresh()
+    logger.info(f"Перерозподілено {len(moved)} каналів між сесіями.")
+    if len(clients) > 1:
+        pending_joins.update(moved.items())
+        join_event.set()
+    return moved
+
+# Чи знає сесія канал: у кеші сутностей Telethon є його access_hash
+async def has_input_channel(session, channel_id):
+    try:
+        await get_input_channel(channel_id, session)
+        return True
+    except ValueError:
+        return False
+
+# Послідовне приєднання сесій до перенесених каналів і сесій-відправників до каналів-джерел
+# після підключення клієнтів
+async def session_joiner():
+    while True:
+        await join_event.wait()
+        join_event.clear()
+        while pending_joins:
+            channel_id, session = pending_joins.pop()
+            if channel_sessions.get(channel_id) == session:
+                await join_channel(session, channel_id)
+            elif session == get_sender_session(channel_id) and not await has_input_channel(session, channel_id):
+                await join_channel(session, channel_id)
+
+# Сесія з FloodWait, довшим за FLOOD_WAIT_MAX, виводиться з кільця до завершення очікування
+async def ban_session(session, seconds):
+    session_banned_until[session] = time.monotonic() + seconds
+    logger.error(f"Сесію {session} виведено з розподілу на {seconds} с через FloodWait.")
+    await rebalance_channels()
+
+# Підключення всіх сесій; додаткові сесії завантажують діалоги, щоб знати канали-приймачі за ID
+async def start_sessions():
+    global join_task
+    for name, session_client in clients.items():
+        await session_client.start()
+        if session_client is not client:
+            await session_client.get_dialogs()
+        logger.info(f"Сесію {name} підключено.")
+    if join_task is None:
+        join_task = asyncio.create_task(session_joiner())
+
+async def stop_sessions():
+    global join_task
+    if join_task:
+        join_task.cancel()
+        await asyncio.gather(join_task, return_exceptions=True)
+        join_task = None
+    for session_client in clients.values():
+        await session_client.disconnect()
+
+# Повернення сесій, час блокування яких минув
+async def restore_sessions():
+    now = time.monotonic()
+    expired = [name for name, until in session_banned_until.items() if until <= now]
+    if not expired:
+        return
+    for name in expired:
+        del session_banned_until[name]
+    logger.info(f"Сесії {', '.join(expired)} повернено до розподілу.")
+    await rebalance_channels()
+
+# Фільтр Блума фіксованого розміру для 64-бітних відбитків
+class BloomFilter:
+    def __init__(self, capacity, error_rate):
+        self.size = max(8, math.ceil(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    # Подвійне хешування: позиції бітів виводяться з двох половин відбитка
+    def positions(self, fingerprint):
+        value = fingerprint & 0xFFFFFFFFFFFFFFFF
+        first, second = value & 0xFFFFFFFF, (value >> 32) | 1
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, fingerprint):
+        for position in self.positions(fingerprint):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, fingerprint):
+        return all(self.bits[position >> 3] & (1 << (position & 7)) for position in self.positions(fingerprint))
+
+# Індекс відбитків повідомлень за вікно DEDUP_WINDOW: точний LRU для останніх
+# відбитків та два покоління фільтра Блума для решти. Покоління змінюються кожні
+# DEDUP_WINDOW секунд, тому відбиток пам'ятається від DEDUP_WINDOW до 2 * DEDUP_WINDOW
+class FingerprintIndex:
+    def __init__(self, window, lru_size, capacity, error_rate):
+        self.window = window
+        self.lru_size = lru_size
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.recent = collections.OrderedDict()  # відбиток -> час першої появи
+        self.forgotten = collections.OrderedDict()  # Відбитки, що лишилися у фільтрах Блума, але не мають блокувати вміст
+        self.current = BloomFilter(capacity, error_rate)
+        self.previous = BloomFilter(capacity, error_rate)
+        self.rotated_at = time.time()
+
+    def rotate_if_needed(self, now):
+        if now - self.rotated_at >= self.window:
+            self.previous = self.current
+            self.current = BloomFilter(self.capacity, self.error_rate)
+            self.rotated_at = now
+
+    def __contains__(self, fingerprint):
+        seen_at = self.recent.get(fingerprint)
+        if seen_at is not None:
+            return time.time() - seen_at < self.window
+        if fingerprint in self.forgotten:
+            return False
+        return fingerprint in self.current or fingerprint in self.previous
+
+    def add(self, fingerprint, seen_at):
+        self.rotate_if_needed(seen_at)
+        self.current.add(fingerprint)
+        self.forgotten.pop(fingerprint, None)
+        self.recent[fingerprint] = seen_at
+        self.recent.move_to_end(fingerprint)
+        if len(self.recent) > self.lru_size:
+            self.recent.popitem(last=False)
+
+    # З фільтра Блума біт не видалити, тому відбиток позначається як забутий
+    def discard(self, fingerprint):
+        self.recent.pop(fingerprint, None)
+        self.forgotten[fingerprint] = True
+        if len(self.forgotten) > self.lru_size:
+            self.forgotten.popitem(last=False)
+
+fingerprint_index = FingerprintIndex(DEDUP_WINDOW, DEDUP_LRU_SIZE, DEDUP_CAPACITY, DEDUP_ERROR_RATE)
+pending_fingerprints = []  # Буфер відкладеного запису: (відбиток, час)
+dedup_stats = {'checked': 0, 'duplicates': 0}
+fingerprints_pruned_at = 0
+
+# Відбиток повідомлення для каналу-приймача: джерело пересилання, якщо воно є, інакше медіа
+# та нормалізований текст. Приймач входить у відбиток, тому той самий вміст не потрапляє двічі
+# в один приймач, але доходить до приймачів, куди його ще не пересилали
+def message_fingerprint(message, destination_id):
+    parts = []
+    fwd_from = message.fwd_from
+    if fwd_from and fwd_from.from_id and fwd_from.channel_post:
+        parts.append(f"fwd:{utils.get_peer_id(fwd_from.from_id)}:{fwd_from.channel_post}")
+    else:
+        if message.photo:
+            parts.append(f"photo:{message.photo.id}")
+        elif message.document:
+            parts.append(f"document:{message.document.id}")
+        text = ' '.join((message.message or '').lower().split())
+        if text:
+            parts.append(text)
+    if not parts:
+        return None
+    parts.append(f"to:{destination_id}")
+    digest = hashlib.blake2b('\x1f'.join(parts).encode(), digest_size=8).digest()
+    return int.from_bytes(digest, 'big', signed=True)  # Знакове 64-бітне число вміщається в INTEGER SQLite
+
+# Перевірка на дублікат без запам'ятовування: вміст, що нікуди не потрапив, не блокує інші канали
+def is_duplicate_message(message, destination_id):
+    if not DEDUP_ENABLED:
+        return False
+    fingerprint = message_fingerprint(message, destination_id)
+    if fingerprint is None:
+        return False
+    dedup_stats['checked'] += 1
+    if fingerprint in fingerprint_index:
+        dedup_stats['duplicates'] += 1
+        metrics.inc('duplicates_total')
+        return True
+    return False
+
+# Маршрути повідомлення без приймачів, які вже отримали цей вміст
+def drop_duplicate_routes(message, destinations):
+    return {
+        destination_id: mode for destination_id, mode in destinations.items()
+        if not is_duplicate_message(message, destination_id)
+    }
+
+# Запам'ятовування відбитків повідомлення для приймачів, куди воно ставиться в чергу.
+# Викликається без await після перевірки, тому однаковий вміст з двох каналів не пройде в приймач двічі
+def remember_message(message, destination_ids):
+    if not DEDUP_ENABLED:
+        return
+    now = time.time()
+    for destination_id in destination_ids:
+        fingerprint = message_fingerprint(message, destination_id)
+        if fingerprint is None:
+            return
+        fingerprint_index.add(fingerprint, now)
+        pending_fingerprints.append((fingerprint, now))
+
+# Видалення відбитків повідомлень, які так і не вдалося доставити
+async def forget_fingerprints(fingerprints):
+    fingerprints = {fingerprint for fingerprint in fingerprints if fingerprint is not None}
+    if not fingerprints:
+        return
+    for fingerprint in fingerprints:
+        fingerprint_index.discard(fingerprint)
+    pending_fingerprints[:] = [row for row in pending_fingerprints if row[0] not in fingerprints]
+    db = await get_db()
+    async with db_lock:
+        await db.executemany('DELETE FROM fingerprints WHERE fingerprint = ?', [(fingerprint,) for fingerprint in fingerprints])
         await db.commit()
-    logger.info(f"last_message_id для каналу {channel_id} оновлено до {last_id}.")
+
+# Завантаження відбитків за останнє вікно з бази даних
+async def load_fingerprints():
+    if not DEDUP_ENABLED:
+        return
+    db = await get_db()
+    count = 0
+    async with db.execute(
+        'SELECT fingerprint, seen_at FROM fingerprints WHERE seen_at > ? ORDER BY seen_at', (time.time() - DEDUP_WINDOW,)
+    ) as cursor:
+        async for fingerprint, seen_at in cursor:
+            fingerprint_index.add(fingerprint, seen_at)
+            count += 1
+    logger.info(f"Завантажено {count} відбитків повідомлень для дедуплікації.")
+
+# Запис буфера відбитків і видалення застарілих
+async def flush_fingerprints():
+    global fingerprints_pruned_at
+    now = time.time()
+    prune = now - fingerprints_pruned_at >= DEDUP_PRUNE_INTERVAL
+    if not pending_fingerprints and not prune:
+        return
+    rows = pending_fingerprints[:]
+    del pending_fingerprints[:len(rows)]
+    db = await get_db()
+    async with db_lock:
+        await db.executemany('INSERT OR REPLACE INTO fingerprints (fingerprint, seen_at) VALUES (?, ?)', rows)
+        if prune:
+            await db.execute('DELETE FROM fingerprints WHERE seen_at <= ?', (now - DEDUP_WINDOW,))
+            fingerprints_pruned_at = now
+        await db.commit()
+
+# Тип вмісту повідомлення для фільтрів маршрутизації
+MEDIA_TYPES = ('text', 'photo', 'video', 'gif', 'audio', 'voice', 'sticker', 'document', 'poll', 'webpage', 'other')
+
+def get_media_type(message):
+    if message.poll:
+        return 'poll'
+    if message.photo:
+        return 'photo'
+    if message.gif:
+        return 'gif'
+    if message.video or message.video_note:
+        return 'video'
+    if message.voice:
+        return 'voice'
+    if message.audio:
+        return 'audio'
+    if message.sticker:
+        return 'sticker'
+    if message.document:
+        return 'document'
+    if message.web_preview:
+        return 'webpage'
+    if message.media:
+        return 'other'
+    return 'text'
+
+# Автомат Ахо-Корасік: усі ключові слова всіх правил шукаються за один прохід по тексту
+class AhoCorasick:
+    def __init__(self, patterns):
+        self.transitions = [{}]
+        self.fail = [0]
+        self.outputs = [set()]
+        for index, pattern in enumerate(patterns):
+            state = 0
+            for char in pattern:
+                next_state = self.transitions[state].get(char)
+                if next_state is None:
+                    next_state = len(self.transitions)
+                    self.transitions[state][char] = next_state
+                    self.transitions.append({})
+                    self.fail.append(0)
+                    self.outputs.append(set())
+                state = next_state
+            self.outputs[state].add(index)
+
+        # Посилання невдач будуються обходом у ширину
+        queue = collections.deque(self.transitions[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self.transitions[state].items():
+                queue.append(next_state)
+                fallback = self.fail[state]
+                while fallback and char not in self.transitions[fallback]:
+                    fallback = self.fail[fallback]
+                self.fail[next_state] = self.transitions[fallback].get(char, 0)
+                self.outputs[next_state] |= self.outputs[self.fail[next_state]]
+
+    # Множина індексів знайдених шаблонів
+    def search(self, text):
+        found = set()
+        state = 0
+        for char in text:
+            while state and char not in self.transitions[state]:
+                state = self.fail[state]
+            state = self.transitions[state].get(char, 0)
+            if self.outputs[state]:
+                found |= self.outputs[state]
+        return found
+
+# Правило маршрутизації, скомпільоване для перевірки повідомлень
+CompiledRoute = collections.namedtuple('CompiledRoute', 'id destination_id include exclude regex media_types mode')
+
+# Скомпільований набір правил: один автомат для ключових слів усіх правил
+# та індекс правил за каналом-джерелом
+class RoutingRules:
+    def __init__(self, routes):
+        keywords = {}
+        self.by_source = {}
+        self.for_all_sources = []
+        self.count = len(routes)
+        for route_id, destination_id, sources, include, exclude, regex, media_types, mode in routes:
+            route = CompiledRoute(
+                route_id,
+                destination_id,
+                frozenset(keywords.setdefault(word, len(keywords)) for word in include),
+                frozenset(keywords.setdefault(word, len(keywords)) for word in exclude),
+                re.compile(regex, re.IGNORECASE) if regex else None,
+                frozenset(media_types),
+                mode
+            )
+            if sources:
+                # Джерело могли ввести як -100..., так і без префікса, тому ключ — позначений ID
+                for source_id in sources:
+                    self.by_source.setdefault(to_peer_id(source_id), []).append(route)
+            else:
+                self.for_all_sources.append(route)
+        # Правила для всіх каналів додаються до кожного індексованого джерела заздалегідь
+        for source_routes in self.by_source.values():
+            source_routes.extend(self.for_all_sources)
+        self.matcher = AhoCorasick(list(keywords)) if keywords else None
+
+    # Канали-приймачі, куди треба переслати повідомлення: ID приймача -> режим доставки.
+    # Якщо до приймача ведуть кілька правил, копіювання має перевагу
+    def match(self, source_id, message):
+        routes = self.by_source.get(to_peer_id(source_id), self.for_all_sources)
+        if not routes:
+            return {}
+
+        media_type = get_media_type(message)
+        text = (message.message or '').lower()
+        found = None
+        destinations = {}
+        for route in routes:
+            if destinations.get(route.destination_id) in (route.mode, 'copy'):
+                continue
+            # Опитування, як і раніше, пропускаються, якщо правило явно їх не дозволяє
+            if route.media_types:
+                if media_type not in route.media_types:
+                    continue
+            elif media_type == 'poll':
+                continue
+            if route.include or route.exclude:
+                if found is None:
+                    found = self.matcher.search(text) if text else set()
+                if route.include and not route.include & found:
+                    continue
+                if route.exclude & found:
+                    continue
+            if route.regex and not route.regex.search(message.message or ''):
+                continue
+            destinations[route.destination_id] = route.mode
+        return destinations
+
+routing_rules = RoutingRules([])
+
+# Розбір списку, розділеного комами
+def split_list(value):
+    return [item.strip() for item in value.split(',') if item.strip()]
+
+# Завантаження правил з бази даних та їх компіляція. Основний канал-приймач
+# працює як правило для всіх каналів без фільтрів
+async def load_routes():
+    global routing_rules
+    db = await get_db()
+    cursor = await db.execute('SELECT route_id, source_id FROM route_sources')
+    sources = {}
+    for route_id, source_id in await cursor.fetchall():
+        sources.setdefault(route_id, []).append(source_id)
+    cursor = await db.execute(
+        'SELECT id, destination_id, include_keywords, exclude_keywords, regex, media_types, mode FROM routes ORDER BY id'
+    )
+    routes = [
+        (route_id, destination_id, sources.get(route_id, []), split_list(include.lower()), split_list(exclude.lower()), regex, split_list(media_types), mode)
+        for route_id, destination_id, include, exclude, regex, media_types, mode in await cursor.fetchall()
+    ]
+    if destination_channel_id:
+        routes.insert(0, (0, destination_channel_id, [], [], [], '', [], DELIVERY_MODE))
+    # Заміна цілим об'єктом: обробник завжди бачить узгоджений набір правил
+    routing_rules = RoutingRules(routes)
+    logger.info(f"Скомпільовано {routing_rules.count} правил маршрутизації.")
+
+# Список правил маршрутизації з таблиці routes
+async def get_routes():
+    db = await get_db()
+    cursor = await db.execute(
+        'SELECT r.id, r.destination_id, r.include_keywords, r.exclude_keywords, r.regex, r.media_types, r.mode, '
+        'GROUP_CONCAT(s.source_id) FROM routes r LEFT JOIN route_sources s ON s.route_id = r.id GROUP BY r.id ORDER BY r.id'
+    )
+    return await cursor.fetchall()
+
+# Додавання правила маршрутизації
+async def add_route(destination_id, sources, include, exclude, regex, media_types, mode='forward'):
+    db = await get_db()
+    async with db_lock:
+        cursor = await db.execute(
+            'INSERT INTO routes (destination_id, include_keywords, exclude_keywords, regex, media_types, mode) VALUES (?, ?, ?, ?, ?, ?)',
+            (destination_id, ', '.join(include), ', '.join(exclude), regex, ', '.join(media_types), mode)
+        )
+        route_id = cursor.lastrowid
+        await db.executemany('INSERT OR IGNORE INTO route_sources (route_id, source_id) VALUES (?, ?)', [(route_id, source_id) for source_id in sources])
+        await db.commit()
+    await load_routes()
+    logger.info(f"Додано правило маршрутизації {route_id} до каналу {destination_id}.")
+    return route_id
+
+# Видалення правила маршрутизації
+async def delete_route(route_id):
+    db = await get_db()
+    async with db_lock:
+        cursor = await db.execute('DELETE FROM routes WHERE id = ?', (route_id,))
+        await db.execute('DELETE FROM route_sources WHERE route_id = ?', (route_id,))
+        await db.commit()
+    await load_routes()
+    logger.info(f"Правило маршрутизації {route_id} видалено.")
+    return cursor.rowcount > 0
+
+# Архів пересланих повідомлень: рядки накопичуються в пам'яті та записуються
+# фоновим завданням відкладеного запису разом з контрольними точками
+pending_archive = []
+archive_pruned_at = time.time()  # Перше очищення — через ARCHIVE_PRUNE_INTERVAL після запуску
+archive_searches = {}  # Останній запит /search у кожному чаті
+
+# Запис про переслане повідомлення; forwarded — повідомлення в каналі-приймачі з forward_messages або копія
+def archive_message(item, forwarded):
+    if not ARCHIVE_ENABLED or forwarded is None:
+        return
+    fwd_from = forwarded.fwd_from
+    message_date = fwd_from.date.timestamp() if fwd_from and fwd_from.date else item.message_date or time.time()
+    pending_archive.append((
+        item.source_id, item.message_id, item.destination_id, forwarded.id,
+        message_date, get_media_type(forwarded), forwarded.message or ''
+    ))
+    if len(pending_archive) >= CHECKPOINT_MAX_PENDING:
+        write_behind_event.set()
+
+async def flush_archive():
+    global archive_pruned_at
+    now = time.time()
+    prune = ARCHIVE_RETENTION and now - archive_pruned_at >= ARCHIVE_PRUNE_INTERVAL
+    if pending_archive:
+        rows = pending_archive[:]
+        del pending_archive[:len(rows)]
+        db = await get_db()
+        async with db_lock:
+            await db.executemany(
+                'INSERT INTO archive (source_id, message_id, destination_id, destination_message_id, message_date, media_type, text) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            await db.commit()
+    if prune:
+        archive_pruned_at = now
+        await prune_archive(now - ARCHIVE_RETENTION)
+
+# Видалення застарілих записів частинами, щоб не тримати db_lock довго, та стиснення індексу FTS5
+async def prune_archive(cutoff):
+    db = await get_db()
+    deleted = 0
+    while True:
+        async with db_lock:
+            cursor = await db.execute(
+                'DELETE FROM archive WHERE id IN (SELECT id FROM archive WHERE message_date < ? LIMIT ?)',
+                (cutoff, ARCHIVE_PRUNE_CHUNK)
+            )
+            await db.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < ARCHIVE_PRUNE_CHUNK:
+            break
+    if deleted:
+        async with db_lock:
+            await db.execute("INSERT INTO archive_fts (archive_fts) VALUES ('optimize')")
+            await db.commit()
+        logger.info(f"З архіву видалено {deleted} застарілих повідомлень.")
+
+# Сторінка результатів пошуку в архіві, від новіших до старіших: before — сторінка після
+# (старіші за) запису, after — сторінка перед (новіші за) записом.
+# Повертає (рядки, чи є новіші, чи є старіші)
+async def search_archive(search, before=None, after=None, limit=ARCHIVE_PAGE_SIZE):
+    condition = ''
+    params = [search]
+    if after is not None:
+        condition = 'AND archive_fts.rowid > ?'
+        params.append(after)
+    elif before is not None:
+        condition = 'AND archive_fts.rowid < ?'
+        params.append(before)
+    order = 'ASC' if after is not None else 'DESC'
+    db = await get_db()
+    cursor = await db.execute(
+        f"""
+        SELECT archive.id, archive.source_id, archive.message_id, archive.destination_id, archive.destination_message_id,
+               archive.message_date, archive.media_type, snippet(archive_fts, 0, '', '', '…', 12), channels.title
+        FROM archive_fts
+        JOIN archive ON archive.id = archive_fts.rowid
+        LEFT JOIN channels ON channels.id = archive.source_id
+        WHERE archive_fts MATCH ? {condition}
+        ORDER BY archive_fts.rowid {order} LIMIT ?
+        """,
+        (*params, limit + 1)
+    )
+    rows = await cursor.fetchall()
+    more = len(rows) > limit
+    rows = rows[:limit]
+    if after is not None:
+        rows.reverse()
+        return rows, more, True
+    return rows, before is not None, more
+
+async def count_archive_matches(search):
+    db = await get_db()
+    cursor = await db.execute('SELECT COUNT(*) FROM archive_fts WHERE archive_fts MATCH ?', (search,))
+    row = await cursor.fetchone()
+    return row[0]
+
+# Посилання на повідомлення каналу для учасників
+def message_link(channel_id, message_id):
+    real_id = utils.resolve_id(channel_id)[0] if channel_id < 0 else channel_id
+    return f"https://t.me/c/{real_id}/{message_id}"
 
 # Функція для отримання історії повідомлень
-async def fetch_channel_history(channel_id, limit=1):
+async def fetch_channel_history(channel_id, limit=1, offset_id=0, add_offset=0, min_id=0, offset_date=None):
     try:
-        result = await client(GetHistoryRequest(
-            peer=PeerChannel(channel_id),
-            limit=limit,  # Отримати останнє повідомлення
-            offset_date=None,
-            offset_id=0,
+        result = await get_channel_client(channel_id)(GetHistoryRequest(
+            peer=await get_input_channel(channel_id),
+            limit=limit,  # За замовчуванням отримати останнє повідомлення
+            offset_date=offset_date,
+            offset_id=offset_id,
             max_id=0,
-            min_id=0,
-            add_offset=0,
+            min_id=min_id,
+            add_offset=add_offset,
             hash=0
         ))
-        logger.info(f"Отримано {len(result.messages)} повідомлень з каналу {channel_id}.")
+        logger.debug("Отримано %d повідомлень з каналу %s.", len(result.messages), channel_id)
         return result.messages
     except Exception as e:
         logger.error(f"Помилка при отриманні історії каналу {channel_id}: {str(e)}", exc_info=True)
         return []
 
-# Функція з повторними спробами пересилання
-async def safe_forward(message, destination_channel, retries=3, delay=2):
-    for attempt in range(1, retries + 1):
+# Визначення ID, після якого починається догонка, з урахуванням обмежень.
+# top_id, уже відомий з перевірки пропусків, заощаджує запит останнього повідомлення
+async def get_backfill_start_id(channel_id, last_id, top_id=None):
+    if top_id is None:
+        top = await fetch_channel_history(channel_id, limit=1)
+        top_id = top[0].id if top else 0
+    if top_id <= last_id:
+        return None
+
+    # Канал без збереженої позиції: як і раніше, пересилається лише останнє повідомлення
+    if not last_id:
+        return top_id - 1
+
+    start_id = last_id
+    if BACKFILL_MAX_MESSAGES and top_id - start_id > BACKFILL_MAX_MESSAGES:
+        start_id = top_id - BACKFILL_MAX_MESSAGES
+    if BACKFILL_MAX_AGE:
+        cutoff = datetime.now(timezone.utc) - timedelta(seconds=BACKFILL_MAX_AGE)
+        older = await fetch_channel_history(channel_id, limit=1, offset_date=cutoff)
+        if older:
+            start_id = max(start_id, older[0].id)
+
+    if start_id > last_id:
+        logger.warning(f"Догонка каналу {channel_id} обмежена: пропущено повідомлення з {last_id + 1} по {start_id}.")
+    return start_id
+
+# Посторінкове отримання пропущених повідомлень від найстаріших до найновіших
+async def iter_missed_pages(channel_id, last_id, top_id=None):
+    start_id = await get_backfill_start_id(channel_id, last_id, top_id)
+    if start_id is None:
+        return
+
+    offset_id = start_id + 1
+    remaining = BACKFILL_MAX_MESSAGES or None
+    while remaining is None or remaining > 0:
+        limit = BACKFILL_PAGE_SIZE if remaining is None else min(BACKFILL_PAGE_SIZE, remaining)
+        # Від'ємний add_offset повертає повідомлення, новіші за offset_id (включно)
+        page = await fetch_channel_history(channel_id, limit=limit, offset_id=offset_id, add_offset=-limit, min_id=start_id)
+        if not page:
+            return
+        # Telegram повертає сторінку від нових до старих
+        messages = [message for message in reversed(page) if isinstance(message, Message)]
+        if messages:
+            yield messages
+            if remaining is not None:
+                remaining -= len(messages)
+        if len(page) < limit:
+            return
+        offset_id = max(message.id for message in page) + 1
+
+# Обмеження швидкості: токен-бакет із резервуванням (токени можуть піти в мінус,
+# тоді кожен наступний запит чекає своєї черги)
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    # Резервує один токен і повертає, скільки секунд треба почекати до його появи
+    def reserve(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        self.tokens -= 1
+        return 0 if self.tokens >= 0 else -self.tokens / self.rate
+
+# Обмежувач запитів одного акаунта: глобальний бакет, бакети для кожного приймача,
+# пауза FloodWait для всіх завдань та ліміт одночасних запитів
+class RateLimiter:
+    def __init__(self, concurrency, global_rate, global_burst, chat_rate, chat_burst):
+        self.concurrency = asyncio.Semaphore(concurrency)
+        self.global_bucket = TokenBucket(global_rate, global_burst)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.chat_buckets = {}
+        self.flood_until = 0
+
+    def report_flood_wait(self, seconds):
+        self.flood_until = max(self.flood_until, time.monotonic() + seconds)
+        logger.warning(f"FloodWait: усі пересилання призупинено на {seconds} с.")
+
+    async def wait_flood(self):
+        delay = self.flood_until - time.monotonic()
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self.flood_until - time.monotonic()
+
+    @contextlib.asynccontextmanager
+    async def slot(self, destination):
+        started = time.perf_counter()
+        async with self.concurrency:
+            await self.wait_flood()
+            bucket = self.chat_buckets.get(destination)
+            if bucket is None:
+                bucket = self.chat_buckets[destination] = TokenBucket(self.chat_rate, self.chat_burst)
+            delay = max(self.global_bucket.reserve(), bucket.reserve())
+            if delay:
+                await asyncio.sleep(delay)
+            # FloodWait міг прийти від іншого завдання, поки це чекало на токен
+            await self.wait_flood()
+            metrics.observe('stage_seconds', time.perf_counter() - started, 'rate_limit_wait')
+            yield
+
+# Ліміти та FloodWait у Telegram діють на акаунт, тому кожна сесія має власний обмежувач
+rate_limiters = {
+    name: RateLimiter(FORWARD_CONCURRENCY, FORWARD_GLOBAL_RATE, FORWARD_GLOBAL_BURST, FORWARD_CHAT_RATE, FORWARD_CHAT_BURST)
+    for name in clients
+}
+
+# Класифікація помилок пересилання: 'flood', 'permanent' або 'transient'
+def classify_forward_error(error):
+    if isinstance(error, (errors.FloodWaitError, errors.SlowModeWaitError)):
+        return 'flood'
+    # Видалені повідомлення, відсутність прав, закриті канали тощо — повтор не допоможе
+    if isinstance(error, (errors.BadRequestError, errors.ForbiddenError, errors.NotFoundError, errors.UnauthorizedError)):
+        return 'permanent'
+    return 'transient'
+
+# Виконання запиту до приймача від імені сесії з обмеженням швидкості та повторами.
+# request отримує клієнт сесії. Повертає (True, результат запиту) або (False, тип помилки з classify_forward_error)
+async def send_with_retries(session, destination, request, description, retries=FORWARD_RETRIES):
+    rate_limiter = rate_limiters[session]
+    attempt = 0
+    flood_waits = 0
+    while attempt < retries:
         try:
-            await message.forward_to(destination_channel)
-            return True
+            async with rate_limiter.slot(destination):
+                started = time.perf_counter()
+                result = await request(clients[session])
+                metrics.observe('stage_seconds', time.perf_counter() - started, 'forward')
+                metrics.inc('forward_attempts_total', 'ok')
+                return True, result
         except Exception as e:
-            logger.warning(f"Спроба {attempt} переслати повідомлення {message.id} з каналу {message.peer_id.channel_id}: {e}")
-            await asyncio.sleep(delay * attempt)  # Експоненційна затримка
-    logger.error(f"Не вдалося переслати повідомлення {message.id} після {retries} спроб.")
-    return False
+            metrics.inc('forward_attempts_total', 'error')
+            metrics.inc('forward_errors_total', type(e).__name__)
+            kind = classify_forward_error(e)
+            if kind == 'permanent':
+                logger.error(f"Не вдалося переслати {description}: {e}. Повтор не виконується.")
+                return False, kind
+            if kind == 'flood':
+                if e.seconds > FLOOD_WAIT_MAX:
+                    rate_limiter.report_flood_wait(e.seconds)
+                    logger.error(f"Не вдалося переслати {description}: FloodWait {e.seconds} с перевищує {FLOOD_WAIT_MAX} с.")
+                    # Канали сесії переходять до інших сесій, повтор з черги піде вже через нового власника
+                    if len(clients) > 1:
+                        await ban_session(session, e.seconds)
+                    return False, kind
+                # Очікування, вказане сервером, не зараховується як спроба, але має власну межу,
+                # щоб приймач, що постійно відповідає FloodWait, не блокував смугу назавжди
+                rate_limiter.report_flood_wait(e.seconds)
+                flood_waits += 1
+                if flood_waits >= FLOOD_WAIT_RETRIES:
+                    logger.error(f"Не вдалося переслати {description}: FloodWait отримано {flood_waits} разів.")
+                    return False, kind
+                continue
+            attempt += 1
+            metrics.inc('forward_retries_total')
+            # Експоненційна затримка з повним джитером
+            delay = random.uniform(0, min(FORWARD_BACKOFF_MAX, FORWARD_BACKOFF_BASE * 2 ** (attempt - 1)))
+            logger.warning("Спроба %d переслати %s: %s", attempt, description, e)
+            if attempt < retries:
+                await asyncio.sleep(delay)
+    logger.error(f"Не вдалося переслати {description} після {retries} спроб.")
+    return False, 'transient'
+
+# Функція з повторними спробами пересилання одного повідомлення
+async def safe_forward(source_id, message_id, destination_channel, retries=FORWARD_RETRIES):
+    session = get_sender_session(source_id)
+    return await send_with_retries(
+        session,
+        destination_channel,
+        lambda sender: forward_from_source(sender, session, source_id, destination_channel, [message_id]),
+        f"повідомлення {message_id} з каналу {source_id}",
+        retries
+    )
+
+# Елемент черги пересилання (рядок таблиці forward_queue)
+QueueItem = collections.namedtuple(
+    'QueueItem', 'row_id source_id message_id destination_id grouped_id message_date enqueued_at attempts next_attempt_at mode fingerprint'
+)
+
+# Стан черги пересилання: впорядковані смуги за парою (джерело, приймач)
+forward_lanes = {}
+lane_semaphore = asyncio.Semaphore(QUEUE_WORKERS)  # Глобальний ліміт одночасних пересилань усіх смуг
+lane_sweeper_task = None
+
+# Постановка повідомлень у чергу пересилання (дублікати ігноруються).
+# routed — список (повідомлення, ID каналу-приймача, режим доставки)
+async def enqueue_messages(source_id, routed):
+    now = time.time()
+    fingerprints = {
+        (message.id, destination_id): message_fingerprint(message, destination_id) for message, destination_id, _ in routed
+    } if DEDUP_ENABLED else {}
+    rows = [
+        (source_id, message.id, destination_id, message.grouped_id, message.date.timestamp() if message.date else None, now, mode,
+         fingerprints.get((message.id, destination_id)))
+        for message, destination_id, mode in routed
+    ]
+    started = time.perf_counter()
+    db = await get_db()
+    try:
+        # db_lock видається по черзі, тому повідомлення записуються в порядку надходження
+        async with db_lock:
+            await db.executemany(
+                'INSERT OR IGNORE INTO forward_queue (source_id, message_id, destination_id, grouped_id, message_date, enqueued_at, mode, fingerprint) '
+                'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                rows
+            )
+            await db.commit()
+    except Exception:
+        # Повідомлення не потрапили в чергу, тож їхній вміст не повинен вважатися пересланим
+        await forget_fingerprints(fingerprints.values())
+        raise
+    metrics.observe('stage_seconds', time.perf_counter() - started, 'db_enqueue')
+    metrics.inc('enqueued_total', value=len(rows))
+    for destination_id in {destination_id for _, destination_id, _ in routed}:
+        wake_forward_lane(source_id, destination_id)
+
+# Голова смуги: найменші ID повідомлень пари (джерело, приймач)
+async def fetch_lane_items(source_id, destination_id, limit):
+    started = time.perf_counter()
+    db = await get_db()
+    cursor = await db.execute(
+        'SELECT id, source_id, message_id, destination_id, grouped_id, message_date, enqueued_at, attempts, next_attempt_at, mode, fingerprint '
+        'FROM forward_queue WHERE source_id = ? AND destination_id = ? ORDER BY message_id LIMIT ?',
+        (source_id, destination_id, limit)
+    )
+    items = [QueueItem(*row) for row in await cursor.fetchall()]
+    metrics.observe('stage_seconds', time.perf_counter() - started, 'db_fetch')
+    return items
+
+# Підтвердження обробки: успішні та безнадійні рядки видаляються, решта відкладається.
+# Повертає рядки, видалені після вичерпання спроб
+async def acknowledge_queue_items(delivered, failed):
+    now = time.time()
+    retry_rows = []
+    dropped_rows = []
+    dropped = []
+    for item in failed:
+        if item.attempts + 1 >= QUEUE_MAX_ATTEMPTS:
+            dropped.append(item)
+            dropped_rows.append((item.row_id,))
+            logger.error(f"Повідомлення {item.message_id} з каналу {item.source_id} видалено з черги після {item.attempts + 1} спроб.")
+        else:
+            delay = min(QUEUE_RETRY_MAX, QUEUE_RETRY_BASE * 2 ** item.attempts) * random.uniform(0.5, 1.0)
+            retry_rows.append((now + delay, item.row_id))
+
+    started = time.perf_counter()
+    db = await get_db()
+    async with db_lock:
+        await db.executemany('DELETE FROM forward_queue WHERE id = ?', [(item.row_id,) for item in delivered] + dropped_rows)
+        await db.executemany('UPDATE forward_queue SET attempts = attempts + 1, next_attempt_at = ? WHERE id = ?', retry_rows)
+        await db.commit()
+    metrics.observe('stage_seconds', time.perf_counter() - started, 'db_ack')
+    metrics.inc('queue_requeued_total', value=len(retry_rows))
+    metrics.inc('queue_dropped_total', value=len(dropped_rows))
+    return dropped
+
+# Просування last_message_id лише до повідомлення, перед яким у черзі не лишилося жодного.
+# Під час догонки позиція так само йде за безперервно обробленим префіксом: сторінки догонки
+# просувають позначку безперервної обробки, а ще не отримана історія лишається розривом
+async def advance_checkpoint(source_id, handled_max_id):
+    db = await get_db()
+    cursor = await db.execute('SELECT MIN(message_id) FROM forward_queue WHERE source_id = ?', (source_id,))
+    min_pending, = await cursor.fetchone()
+    high_water_mark = handled_max_id if min_pending is None else min(handled_max_id, min_pending - 1)
+    # Позиція не перескакує розрив, доки його не закриє догонка або пошук пропусків
+    high_water_mark = min(high_water_mark, get_handled_through_id(source_id))
+    if high_water_mark > await get_last_message_id(source_id):
+        await update_last_message_id(source_id, high_water_mark)
+
+# Позначка безперервної обробки: ID, до якого включно всі повідомлення каналу поставлені в чергу,
+# переслані або свідомо пропущені. Живі повідомлення після розриву чекають у handled_ahead_ids,
+# доки розрив не закриє догонка або пошук пропусків. Позначка ставиться лише після постановки в чергу,
+# тому повідомлення, обробка якого впала з помилкою, залишається розривом і буде догнане
+handled_through_ids = {}  # channel_id -> ID
+handled_ahead_ids = {}  # channel_id -> множина ID, оброблених після розриву
+
+def get_handled_through_id(channel_id):
+    return max(handled_through_ids.get(channel_id, 0), last_message_ids.get(channel_id, 0))
+
+# through=True: усі повідомлення до message_id включно вже отримано з історії каналу
+def mark_handled(channel_id, message_id, through=False):
+    # Без пошуку пропусків розрив ніхто не закриє, тому позначка, як і позиція, просто йде за повідомленнями.
+    # Виняток — догонка каналу: розрив до живих повідомлень закриють її сторінки
+    through = through or not GAP_CHECK_ENABLED and channel_id not in catchup_start_ids
+    handled_id = get_handled_through_id(channel_id)
+    ahead = handled_ahead_ids.get(channel_id, set())
+    if through and message_id > handled_id:
+        handled_id = message_id
+        ahead = {ahead_id for ahead_id in ahead if ahead_id > handled_id}
+    elif message_id == handled_id + 1:
+        handled_id = message_id
+    elif message_id > handled_id:
+        ahead.add(message_id)
+    while handled_id + 1 in ahead:
+        handled_id += 1
+        ahead.discard(handled_id)
+    handled_through_ids[channel_id] = handled_id
+    if ahead:
+        handled_ahead_ids[channel_id] = ahead
+        expedite_gap_check(channel_id)
+    else:
+        handled_ahead_ids.pop(channel_id, None)
+
+# Розбиття рядків черги на пакети для forward_messages: одна пара (джерело, приймач),
+# не більше FORWARD_BATCH_SIZE повідомлень і без розривання альбомів
+def split_into_batches(items):
+    groups = {}
+    for item in items:
+        groups.setdefault((item.source_id, item.destination_id), []).append(item)
+
+    batches = []
+    for group in groups.values():
+        group.sort(key=lambda item: item.message_id)
+        batch = []
+        for item in group:
+            starts_new_group = item.grouped_id is None or not batch or batch[-1].grouped_id != item.grouped_id
+            # Новий альбом має повністю поміститися в пакет, тому місце для нього резервується заздалегідь
+            limit = FORWARD_BATCH_SIZE - ALBUM_MAX_SIZE if item.grouped_id else FORWARD_BATCH_SIZE
+            # Пересилання та копіювання виконуються різними запитами, тому не змішуються в пакеті
+            if batch and (starts_new_group and len(batch) >= limit or batch[-1].mode != item.mode):
+                batches.append(batch)
+                batch = []
+            batch.append(item)
+        if batch:
+            batches.append(batch)
+    return batches
+
+# Пересилання пакета одним викликом forward_messages від сесії-відправника.
+# Повертає список результатів (успіх, тип помилки) для кожного елемента;
+# (False, None) означає, що елемент не пересилався, бо попередній не вдалося переслати
+async def forward_batch(batch):
+    if batch[0].mode == 'copy':
+        return await copy_batch(batch)
+    source_id = batch[0].source_id
+    destination = batch[0].destination_id
+    results = [(False, 'transient')] * len(batch)
+    session = get_sender_session(source_id)
+    success, forwarded = await send_with_retries(
+        session,
+        destination,
+        lambda sender: forward_from_source(sender, session, source_id, destination, [item.message_id for item in batch]),
+        f"пакет з {len(batch)} повідомлень з каналу {source_id}"
+    )
+    if success:
+        results = [(item is not None, None if item is not None else 'transient') for item in forwarded]
+        for item, message in zip(batch, forwarded):
+            archive_message(item, message)
+    elif forwarded != 'permanent':
+        # FloodWait або вичерпані повтори: поштучне пересилання лише помножило б запити,
+        # тому пакет цілком повертається в чергу
+        return [(False, 'transient')] * len(batch)
+    else:
+        logger.warning(f"Пакет з каналу {source_id} не переслано, пересилаємо поштучно.")
+
+    # Поштучно пересилаються лише повідомлення, відсутні в частковому результаті пакета,
+    # або всі, якщо пакет відхилено остаточною помилкою через одне з них
+    for index, item in enumerate(batch):
+        if not results[index][0]:
+            results[index] = await safe_forward(source_id, item.message_id, destination)
+            if results[index][0]:
+                archive_message(item, results[index][1][0])
+            # Пізніші повідомлення не можуть обігнати те, що чекає на повтор (після збою або FloodWait)
+            if not results[index][0] and results[index][1] != 'permanent':
+                results[index + 1:] = [(False, None)] * (len(batch) - index - 1)
+                break
+    return results
+
+# Ключ кешу медіа — ID медіа в каналі-джерелі: той самий файл, опублікований у різних каналах, має той самий ID
+def media_cache_key(message):
+    if message.photo:
+        return f"photo:{message.photo.id}"
+    if message.document:
+        return f"document:{message.document.id}"
+    return None
+
+# Медіа, вже надіслане сесією копією раніше, як посилання для повторного надсилання
+async def get_cached_media(session, key):
+    db = await get_db()
+    cursor = await db.execute(
+        'SELECT kind, media_id, access_hash, file_reference FROM media_cache WHERE session = ? AND source_key = ?', (session, key)
+    )
+    row = await cursor.fetchone()
+    if not row:
+        return None
+    kind, media_id, access_hash, file_reference = row
+    if kind == 'photo':
+        return InputMediaPhoto(InputPhoto(media_id, access_hash, file_reference))
+    return InputMediaDocument(InputDocument(media_id, access_hash, file_reference))
+
+# Збереження посилань на медіа з надісланих копій; sources і sent вирівняні за позицією
+async def save_cached_media(session, sources, sent):
+    now = time.time()
+    rows = []
+    for message, copy in zip(sources, sent):
+        key = media_cache_key(message)
+        media = copy and (copy.photo or copy.document)
+        if key and media:
+            rows.append((session, key, 'photo' if copy.photo else 'document', media.id, media.access_hash, media.file_reference, now))
+    if not rows:
+        return
+    db = await get_db()
+    async with db_lock:
+        await db.executemany(
+            'INSERT OR REPLACE INTO media_cache (session, source_key, kind, media_id, access_hash, file_reference, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?)',
+            rows
+        )
+        await db.commit()
 
-# Функція для обмеження швидкості
-semaphore = asyncio.Semaphore(5)  # Максимум 5 одночасних пересилань
+# Видалення застарілих посилань частинами, як і для архіву; file_reference старих записів однаково вже недійсні
+media_cache_pruned_at = time.time()
+
+async def prune_media_cache():
+    global media_cache_pruned_at
+    now = time.time()
+    if not MEDIA_CACHE_RETENTION or now - media_cache_pruned_at < MEDIA_CACHE_PRUNE_INTERVAL:
+        return
+    media_cache_pruned_at = now
+    db = await get_db()
+    deleted = 0
+    while True:
+        async with db_lock:
+            cursor = await db.execute(
+                'DELETE FROM media_cache WHERE rowid IN (SELECT rowid FROM media_cache WHERE updated_at < ? LIMIT ?)',
+                (now - MEDIA_CACHE_RETENTION, ARCHIVE_PRUNE_CHUNK)
+            )
+            await db.commit()
+        deleted += cursor.rowcount
+        if cursor.rowcount < ARCHIVE_PRUNE_CHUNK:
+            break
+    if deleted:
+        logger.info(f"З кешу медіа видалено {deleted} застарілих посилань.")
+
+async def forget_cached_media(session, sources):
+    keys = [(session, key) for key in map(media_cache_key, sources) if key]
+    db = await get_db()
+    async with db_lock:
+        await db.executemany('DELETE FROM media_cache WHERE session = ? AND source_key = ?', keys)
+        await db.commit()
+
+def copy_file_name(message):
+    if message.photo:
+        return 'photo.jpg'
+    for attribute in message.document.attributes:
+        if isinstance(attribute, DocumentAttributeFilename):
+            return attribute.file_name
+    return 'file' + utils.get_extension(message.document)
+
+# Потокове перезавантаження медіа: частини по COPY_CHUNK_SIZE пишуться в SpooledTemporaryFile,
+# який тримає в пам'яті не більше COPY_SPOOL_MAX байт, і вивантажуються сесією-відправником
+async def reupload_media(session, source_id, message):
+    started = time.perf_counter()
+    with tempfile.SpooledTemporaryFile(max_size=COPY_SPOOL_MAX) as file:
+        async for chunk in get_channel_client(source_id).iter_download(message.photo or message.document, request_size=COPY_CHUNK_SIZE):
+            await asyncio.to_thread(file.write, chunk)
+        size = file.tell()
+        file.seek(0)
+        uploaded = await clients[session].upload_file(
+            file, file_size=size, file_name=copy_file_name(message), part_size_kb=COPY_CHUNK_SIZE // 1024
+        )
+    metrics.observe('stage_seconds', time.perf_counter() - started, 'copy_reupload')
+    metrics.inc('copy_reuploads_total')
+    if message.photo:
+        return InputMediaUploadedPhoto(uploaded)
+    return InputMediaUploadedDocument(uploaded, message.document.mime_type, message.document.attributes)
+
+# Медіа для копії: з кешу, за посиланням на оригінал або через перезавантаження.
+# None — повідомлення надсилається як текст
+async def get_copy_media(session, source_id, message, use_cache=True):
+    key = media_cache_key(message)
+    if key is None:
+        # Геопозиції, контакти тощо надсилаються за посиланням; прев'ю посилання сформує сам Telegram
+        if message.media and not message.web_preview and not message.poll and not message.noforwards:
+            return message.media
+        return None
+    if use_cache:
+        cached = await get_cached_media(session, key)
+        if cached:
+            metrics.inc('copy_cache_hits_total')
+            return cached
+    # Без захисту вмісту сесія-власник надсилає файл за посиланням на оригінал, без завантаження
+    if not message.noforwards and session == get_channel_session(source_id):
+        return message.media
+    return await reupload_media(session, source_id, message)
+
+# Альбом одним SendMultiMediaRequest: кожен елемент несе власний підпис з entities оригіналу.
+# Повертає надіслані повідомлення в порядку елементів (None, якщо елемента немає у відповіді)
+async def send_album(sender, destination, messages, files):
+    peer = await sender.get_input_entity(destination)
+    multi_media = []
+    for message, file in zip(messages, files):
+        media = utils.get_input_media(file)
+        if isinstance(media, (InputMediaUploadedPhoto, InputMediaUploadedDocument)):
+            # Завантажений файл спершу реєструється на сервері, як це робить send_file для альбомів
+            media = utils.get_input_media(await sender(UploadMediaRequest(peer, media)))
+        multi_media.append(InputSingleMedia(
+            media, random_id=helpers.generate_random_long(), message=message.message or '', entities=message.entities
+        ))
+    result = await sender(SendMultiMediaRequest(peer, multi_media))
+    ids = {update.random_id: update.id for update in result.updates if isinstance(update, UpdateMessageID)}
+    sent = {
+        update.message.id: update.message
+        for update in result.updates if isinstance(update, (UpdateNewChannelMessage, UpdateNewMessage))
+    }
+    return [sent.get(ids.get(media.random_id)) for media in multi_media]
+
+# Надсилання копії одного повідомлення або альбому; повертає список надісланих повідомлень.
+# parse_mode=None: текст оригіналу не розбирається як markdown, форматування задають лише його entities
+async def send_copy(sender, session, source_id, destination, messages, use_cache=True):
+    files = [await get_copy_media(session, source_id, message, use_cache) for message in messages]
+    if len(messages) > 1:
+        return await send_album(sender, destination, messages, files)
+    message = messages[0]
+    if files[0] is None:
+        sent = await sender.send_message(
+            destination, message.message or '', formatting_entities=message.entities,
+            parse_mode=None, link_preview=bool(message.web_preview)
+        )
+    else:
+        sent = await sender.send_file(
+            destination, files[0], caption=message.message or '', formatting_entities=message.entities, parse_mode=None
+        )
+    return [sent]
+
+# Копія з повторами; застаріле посилання з кешу замінюється перезавантаженням
+async def copy_messages(session, source_id, destination, messages):
+    async def request(sender):
+        try:
+            sent = await send_copy(sender, session, source_id, destination, messages)
+        except (errors.FileReferenceExpiredError, errors.MediaEmptyError):
+            await forget_cached_media(session, messages)
+            sent = await send_copy(sender, session, source_id, destination, messages, use_cache=False)
+        await save_cached_media(session, messages, sent)
+        return sent
+
+    return await send_with_retries(
+        session, destination, request, f"копію {len(messages)} повідомлень з каналу {source_id}"
+    )
+
+# Копіювання пакета: повідомлення читає сесія-власник каналу, альбоми надсилаються одним запитом.
+# Результати мають той самий формат, що й у forward_batch
+async def copy_batch(batch):
+    source_id = batch[0].source_id
+    destination = batch[0].destination_id
+    try:
+        messages = await get_channel_client(source_id).get_messages(
+            await get_input_channel(source_id), ids=[item.message_id for item in batch]
+        )
+    except Exception as e:
+        logger.warning(f"Не вдалося отримати повідомлення з каналу {source_id} для копіювання: {e}")
+        return [(False, 'transient')] * len(batch)
+
+    units = []
+    for item, message in zip(batch, messages):
+        if units and item.grouped_id and units[-1][-1][0].grouped_id == item.grouped_id:
+            units[-1].append((item, message))
+        else:
+            units.append([(item, message)])
+
+    session = get_sender_session(source_id)
+    results = [(False, None)] * len(batch)
+    index = 0
+    for unit in units:
+        # Видалені з каналу-джерела повідомлення копіювати нічого
+        present = [(item, message) for item, message in unit if message is not None]
+        unit_results = [(False, 'permanent')] * len(unit)
+        if present:
+            success, sent = await copy_messages(session, source_id, destination, [message for _, message in present])
+            if success:
+                for (item, _), copy in zip(present, sent):
+                    archive_message(item, copy)
+                unit_results = [(message is not None, None if message is not None else 'permanent') for _, message in unit]
+            elif sent != 'permanent':
+                # Пізніші повідомлення не можуть обігнати те, що чекає на повтор
+                results[index:index + len(unit)] = [(False, 'transient')] * len(unit)
+                break
+        results[index:index + len(unit)] = unit_results
+        index += len(unit)
+    return results
+
+# Впорядкована смуга пересилання для пари (джерело, приймач): повідомлення
+# пересилаються строго послідовно, різні смуги працюють паралельно
+class ForwardLane:
+    def __init__(self, source_id, destination_id):
+        self.source_id = source_id
+        self.destination_id = destination_id
+        self.woken = False
+        self.task = None
+
+    def wake(self):
+        self.woken = True
+        if self.task is None:
+            self.task = asyncio.create_task(self.run())
+
+    async def run(self):
+        try:
+            # Коротке вікно, щоб нові повідомлення накопичилися в пакет
+            await asyncio.sleep(FORWARD_BATCH_WINDOW)
+            while True:
+                self.woken = False
+                try:
+                    items = await fetch_lane_items(self.source_id, self.destination_id, FORWARD_BATCH_SIZE + ALBUM_MAX_SIZE)
+                    if not items:
+                        # Між перевіркою та виходом немає await, тому нові рядки не загубляться
+                        if self.woken:
+                            continue
+                        return
+
+                    # Голова смуги чекає на повтор — решта повідомлень чекає разом з нею
+                    delay = items[0].next_attempt_at - time.time()
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+                        continue
+
+                    ready = list(itertools.takewhile(lambda item: item.next_attempt_at <= time.time(), items))
+                    batch = split_into_batches(ready)[0]
+                    waited = time.perf_counter()
+                    async with lane_semaphore:
+                        metrics.observe('stage_seconds', time.perf_counter() - waited, 'lane_wait')
+                        results = await forward_batch(batch)
+                    await self.complete(batch, results)
+                except Exception as e:
+                    logger.error(f"Помилка у смузі пересилання {self.source_id} -> {self.destination_id}: {str(e)}", exc_info=True)
+                    await asyncio.sleep(QUEUE_POLL_INTERVAL)
+        finally:
+            self.task = None
+            if forward_lanes.get((self.source_id, self.destination_id)) is self:
+                del forward_lanes[(self.source_id, self.destination_id)]
+
+    async def complete(self, batch, results):
+        handled = [item for item, (success, kind) in zip(batch, results) if success or kind == 'permanent']
+        # FloodWait, що вичерпав межу очікувань, повторюється з черги так само, як тимчасова помилка
+        failed = [item for item, (success, kind) in zip(batch, results) if not success and kind in ('transient', 'flood')]
+        dropped = await acknowledge_queue_items(handled, failed)
+        # Недоставлений вміст не повинен блокувати той самий пост з інших каналів
+        undelivered = dropped + [item for item, (success, kind) in zip(batch, results) if not success and kind == 'permanent']
+        if undelivered:
+            await forget_fingerprints(item.fingerprint for item in undelivered)
+        now = time.time()
+        for item, (success, _) in zip(batch, results):
+            if success:
+                metrics.inc('forwarded_total', item.source_id)
+                if item.message_date:
+                    metrics.observe('end_to_end_seconds', now - item.message_date)
+                    metrics.observe('source_end_to_end_seconds', now - item.message_date, item.source_id)
+                log_summary.note('forwarded', "Повідомлення %s з каналу %s переслано до каналу %s", item.message_id, item.source_id, item.destination_id)
+                if not first_live_reported:
+                    report_first_live_forward(item)
+        if handled:
+            await advance_checkpoint(self.source_id, max(item.message_id for item in handled))
+
+# Запуск смуги для пари (джерело, приймач), якщо вона ще не працює
+def wake_forward_lane(source_id, destination_id):
+    lane = forward_lanes.get((source_id, destination_id))
+    if lane is None:
+        lane = forward_lanes[(source_id, destination_id)] = ForwardLane(source_id, destination_id)
+    lane.wake()
+
+# Запуск смуг для всіх пар, що мають рядки в черзі
+async def wake_queued_lanes():
+    db = await get_db()
+    cursor = await db.execute('SELECT DISTINCT source_id, destination_id FROM forward_queue')
+    for source_id, destination_id in await cursor.fetchall():
+        wake_forward_lane(source_id, destination_id)
+
+# Періодична перевірка черги як страховка від смуг, що завершилися через помилки
+async def forward_lane_sweeper():
+    while True:
+        try:
+            await restore_sessions()
+            await wake_queued_lanes()
+        except Exception as e:
+            logger.error(f"Помилка при перевірці черги пересилання: {str(e)}", exc_info=True)
+        await asyncio.sleep(QUEUE_POLL_INTERVAL)
+
+# Запуск пересилання з черги
+def start_forward_workers():
+    global lane_sweeper_task
+    lane_sweeper_task = asyncio.create_task(forward_lane_sweeper())
+    logger.info(f"Запущено пересилання з черги (до {QUEUE_WORKERS} одночасних смуг).")
+
+# Зупинка пересилання з черги
+async def stop_forward_workers():
+    global lane_sweeper_task
+    tasks = [lane.task for lane in forward_lanes.values() if lane.task]
+    if lane_sweeper_task:
+        tasks.append(lane_sweeper_task)
+        lane_sweeper_task = None
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    forward_lanes.clear()
+
+# Статистика черги пересилання: (кількість рядків, рядків з повторами, вік найстарішого рядка в секундах)
+async def get_queue_stats():
+    db = await get_db()
+    cursor = await db.execute('SELECT COUNT(*), SUM(attempts > 0), MIN(enqueued_at) FROM forward_queue')
+    count, retrying, oldest = await cursor.fetchone()
+    return count, retrying or 0, time.time() - oldest if oldest else 0
+
+# Стан догонки при запуску. Смуги пересилають живі повідомлення одразу, а пропущені
+# потрапляють у ту саму чергу й пересилаються в порядку ID з того, що в ній є.
+# Догонка починається з позиції на момент запуску, а позиція каналу просувається лише до
+# безперервно обробленого префікса, тому перезапуск посеред догонки нічого не втрачає.
+# Живі повідомлення, поставлені в чергу під час догонки, сторінки догонки пропускають
+catchup_start_ids = {}  # channel_id -> last_message_id на момент запуску, доки догонка каналу не завершена
+catchup_live_ids = {}  # channel_id -> множина ID, поставлених у чергу живим обробником під час догонки
+catchup_order = collections.deque()
+catchup_prioritized = set()
+
+def begin_catchup():
+    for channel_id in monitored_channels.values():
+        catchup_start_ids[channel_id] = last_message_ids.get(channel_id, 0)
+        catchup_order.append(channel_id)
+    logger.info(f"Заплановано перевірку пропущених повідомлень для {len(catchup_order)} каналів.")
+
+# Завершення догонки каналу, зокрема перерваної; позиція просувається до повідомлень,
+# які смуги переслали, поки сторінки догонки ще надходили
+async def finish_catchup(channel_id):
+    catchup_start_ids.pop(channel_id, None)
+    catchup_live_ids.pop(channel_id, None)
+    # Без пошуку пропусків розрив, який не закрила догонка, ніхто не закриє
+    ahead = handled_ahead_ids.get(channel_id)
+    if ahead and not GAP_CHECK_ENABLED:
+        mark_handled(channel_id, max(ahead), through=True)
+    await advance_checkpoint(channel_id, get_handled_through_id(channel_id))
+
+# Запам'ятовування живого повідомлення, яке обробник ставить у чергу під час догонки каналу
+def note_catchup_live_message(channel_id, message_id):
+    if channel_id in catchup_start_ids:
+        catchup_live_ids.setdefault(channel_id, set()).add(message_id)
+
+# Перенесення каналу з живими повідомленнями на початок черги догонки
+def prioritize_catchup(channel_id):
+    if channel_id not in catchup_start_ids or channel_id in catchup_prioritized:
+        return
+    catchup_prioritized.add(channel_id)
+    try:
+        catchup_order.remove(channel_id)
+    except ValueError:
+        return  # Догонка каналу вже виконується
+    catchup_order.appendleft(channel_id)
+
+# Час запуску та живі повідомлення в черзі для вимірювання затримки до першого успішного пересилання
+started_at = time.monotonic()
+first_live_reported = False
+first_live_candidates = set()  # (джерело, ID повідомлення), поставлені в чергу до першого пересилання
+
+def note_live_message(channel_id, message_id):
+    if not first_live_reported and len(first_live_candidates) < FORWARD_BATCH_SIZE:
+        first_live_candidates.add((channel_id, message_id))
+
+def report_first_live_forward(item):
+    global first_live_reported
+    if (item.source_id, item.message_id) in first_live_candidates:
+        first_live_reported = True
+        first_live_candidates.clear()
+        logger.info(f"Перше живе повідомлення переслано через {time.monotonic() - started_at:.1f} с після запуску.")
 
 # Функція для обробки пропущених повідомлень
-async def process_missed_messages(channel_id, destination_channel):
-    messages = await fetch_channel_history(channel_id)
-    if not messages:
+async def process_missed_messages(channel_id):
+    last_id = catchup_start_ids.get(channel_id)
+    if last_id is None:
+        last_id = await get_last_message_id(channel_id)
+
+    async for messages in iter_missed_pages(channel_id, last_id):
+        await enqueue_missed_page(channel_id, messages)
+
+# Дедуплікація, маршрутизація та постановка в чергу сторінки пропущених повідомлень.
+# Повідомлення, вже оброблені живим обробником після розриву або під час догонки, пропускаються.
+# Повертає кількість повідомлень сторінки, яких живий обробник не бачив
+async def enqueue_missed_page(channel_id, messages):
+    ahead = handled_ahead_ids.get(channel_id, ())
+    live = catchup_live_ids.get(channel_id, ())
+    missed = [message for message in messages if message.id not in ahead and message.id not in live]
+    routed = []
+    for message in missed:
+        destinations = drop_duplicate_routes(message, routing_rules.match(channel_id, message))
+        if destinations:
+            remember_message(message, destinations)
+            routed.extend((message, destination_id, mode) for destination_id, mode in destinations.items())
+    if routed:
+        # Кожна сторінка одразу зберігається в черзі; last_message_id просуне смуга після пересилання
+        await enqueue_messages(channel_id, routed)
+        logger.info("Поставлено в чергу %d пропущених повідомлень з каналу %s.", len(routed), channel_id)
+    mark_handled(channel_id, messages[-1].id, through=True)
+    return len(missed)
+
+# Пошук пропусків під час роботи: повідомлення, що не надійшли живими оновленнями
+# (розрив з'єднання, відставання оновлень Telegram), знаходяться порівнянням top_message
+# каналу з його збереженою позицією, і догоняється лише діапазон після позначки безперервної обробки.
+# Розрив у живому потоці прискорює перевірку каналу.
+# Усі запити перевірок ділять один невеликий бюджет, окремий від лімітів пересилання
+gap_schedule = {}  # channel_id -> (час наступної перевірки, поточний інтервал)
+gap_top_ids = {}  # channel_id -> top_message на момент попередньої перевірки
+gap_budget = TokenBucket(GAP_CHECK_RATE, GAP_CHECK_BURST)
+gap_detector_task = None
+
+# Перевірка каналу з розривом у живому потоці через GAP_CHECK_GRACE, коли пропущені повідомлення
+# вже не можуть бути живими оновленнями, що просто затрималися
+def expedite_gap_check(channel_id):
+    scheduled = gap_schedule.get(channel_id)
+    if scheduled:
+        due_at = time.monotonic() + GAP_CHECK_GRACE
+        if scheduled[0] > due_at:
+            gap_schedule[channel_id] = (due_at, scheduled[1])
+
+async def wait_gap_budget():
+    delay = gap_budget.reserve()
+    if delay:
+        await asyncio.sleep(delay)
+
+# Сесія, що чекає FloodWait або пересилає на повну, пропускає перевірки до наступного проходу
+def gap_session_idle(session):
+    now = time.monotonic()
+    limiter = rate_limiters[session]
+    return (session_banned_until.get(session, 0) <= now and limiter.flood_until <= now
+            and not limiter.concurrency.locked())
+
+# Синхронізація розкладу зі списком каналів; перші перевірки нових каналів розносяться в часі
+def sync_gap_schedule():
+    channels = set(monitored_channels.values())
+    for channel_id in gap_schedule.keys() - channels:
+        del gap_schedule[channel_id]
+        gap_top_ids.pop(channel_id, None)
+        handled_through_ids.pop(channel_id, None)
+        handled_ahead_ids.pop(channel_id, None)
+    now = time.monotonic()
+    for channel_id in channels - gap_schedule.keys():
+        gap_schedule[channel_id] = (now + random.uniform(0, GAP_CHECK_MIN_INTERVAL), GAP_CHECK_MIN_INTERVAL)
+        gap_top_ids[channel_id] = get_handled_through_id(channel_id)
+
+# Інтервал підлаштовується під активність: пропуск повертає мінімальний інтервал,
+# нові повідомлення з попередньої перевірки скорочують його вдвічі, тиша — подвоює
+def schedule_gap_check(channel_id, top_id, missed):
+    if channel_id not in gap_schedule:
+        return  # Канал видалено під час перевірки
+    interval = gap_schedule[channel_id][1]
+    if missed:
+        interval = GAP_CHECK_MIN_INTERVAL
+    elif top_id > gap_top_ids.get(channel_id, 0):
+        interval = max(GAP_CHECK_MIN_INTERVAL, interval / 2)
+    else:
+        interval = min(GAP_CHECK_MAX_INTERVAL, interval * 2)
+    gap_top_ids[channel_id] = max(top_id, gap_top_ids.get(channel_id, 0))
+    gap_schedule[channel_id] = (time.monotonic() + interval * random.uniform(0.9, 1.1), interval)
+
+# top_message каналів однієї сесії: один GetPeerDialogsRequest на GAP_CHECK_BATCH каналів.
+# Канали без діалогу в сесії перевіряються через GetHistoryRequest з limit=1
+async def fetch_top_message_ids(session, channel_ids):
+    session_client = clients[session]
+    peers = {}
+    for channel_id in channel_ids:
+        try:
+            peers[to_peer_id(channel_id)] = (channel_id, await get_input_channel(channel_id, session))
+        except (ValueError, TypeError):
+            continue  # Сутності немає в кеші сесії
+
+    top_ids = {}
+    if peers:
+        await wait_gap_budget()
+        try:
+            result = await session_client(GetPeerDialogsRequest(peers=[InputDialogPeer(peer) for _, peer in peers.values()]))
+            for dialog in result.dialogs:
+                entry = peers.get(utils.get_peer_id(dialog.peer))
+                if entry:
+                    top_ids[entry[0]] = dialog.top_message
+        except errors.FloodWaitError as e:
+            rate_limiters[session].report_flood_wait(e.seconds)
+            return top_ids
+        except Exception as e:
+            logger.error(f"Помилка при отриманні діалогів сесії {session}: {str(e)}", exc_info=True)
+
+    for channel_id in channel_ids:
+        if channel_id not in top_ids:
+            await wait_gap_budget()
+            top = await fetch_channel_history(channel_id, limit=1)
+            if top:
+                top_ids[channel_id] = top[0].id
+    return top_ids
+
+# Догонка лише діапазону після останнього відомого ID. Найновіші повідомлення, можливо,
+# ще надходять живими оновленнями, тому вони залишаються наступній перевірці
+async def repair_gap(channel_id, handled_id, top_id):
+    cutoff = datetime.now(timezone.utc) - timedelta(seconds=GAP_CHECK_GRACE)
+    missed = 0
+    complete = True
+    async for messages in iter_missed_pages(channel_id, handled_id, top_id):
+        ready = list(itertools.takewhile(lambda message: message.date <= cutoff, messages))
+        if ready:
+            missed += await enqueue_missed_page(channel_id, ready)
+        if len(ready) < len(messages):
+            complete = False
+            break
+        await wait_gap_budget()
+    if complete:
+        # Решта ID до top_message — службові або видалені повідомлення
+        mark_handled(channel_id, top_id, through=True)
+    if missed:
+        metrics.inc('gaps_repaired_total')
+        metrics.inc('gap_messages_total', value=missed)
+        logger.warning("Знайдено пропуск у каналі %s: %d повідомлень після %s не надійшли живими оновленнями.", channel_id, missed, handled_id)
+    return missed
+
+# Один прохід планувальника: перевірка каналів, для яких настав час, групами за сесіями
+async def check_gaps():
+    # Поки триває догонка після запуску, пропущені повідомлення шукає вона
+    if catchup_start_ids or not routing_rules.count:
         return
+    sync_gap_schedule()
+    now = time.monotonic()
+    due = collections.defaultdict(list)
+    for channel_id, (next_at, _) in gap_schedule.items():
+        if next_at <= now:
+            due[get_channel_session(channel_id)].append(channel_id)
+
+    for session, channel_ids in due.items():
+        for start in range(0, len(channel_ids), GAP_CHECK_BATCH):
+            if not gap_session_idle(session):
+                break  # Канали лишаються в розкладі й перевіряться в наступному проході
+            batch = channel_ids[start:start + GAP_CHECK_BATCH]
+            top_ids = await fetch_top_message_ids(session, batch)
+            metrics.inc('gap_checks_total', value=len(top_ids))
+            for channel_id in batch:
+                if channel_id not in top_ids:
+                    continue
+                top_id = top_ids[channel_id]
+                missed = 0
+                if top_id > await get_last_message_id(channel_id):
+                    # Усе до позначки вже в черзі або пропущене фільтрами, тому догоняється лише решта
+                    handled_id = get_handled_through_id(channel_id)
+                    if top_id > handled_id:
+                        missed = await repair_gap(channel_id, handled_id, top_id)
+                    # Позиція просувається й над відфільтрованими повідомленнями, яких немає в черзі
+                    await advance_checkpoint(channel_id, get_handled_through_id(channel_id))
+                schedule_gap_check(channel_id, top_id, missed)
+
+async def gap_detector():
+    while True:
+        await asyncio.sleep(GAP_CHECK_TICK)
+        try:
+            await check_gaps()
+        except Exception as e:
+            logger.error(f"Помилка при пошуку пропусків: {str(e)}", exc_info=True)
+
+def start_gap_detector():
+    global gap_detector_task
+    if GAP_CHECK_ENABLED:
+        gap_detector_task = asyncio.create_task(gap_detector())
+        logger.info(f"Запущено пошук пропусків (бюджет {GAP_CHECK_RATE} запитів/с, інтервал {GAP_CHECK_MIN_INTERVAL}–{GAP_CHECK_MAX_INTERVAL} с).")
+
+async def stop_gap_detector():
+    global gap_detector_task
+    if gap_detector_task:
+        gap_detector_task.cancel()
+        await asyncio.gather(gap_detector_task, return_exceptions=True)
+        gap_detector_task = None
+
+# Канал, розпізнаний через кеш entities або get_entity
+ResolvedChannel = collections.namedtuple('ResolvedChannel', 'id username access_hash title type')
+
+# Обмеження запитів get_entity (ResolveUsernameRequest має жорсткі ліміти FloodWait)
+resolve_limiter = RateLimiter(RESOLVE_CONCURRENCY, RESOLVE_RATE, RESOLVE_BURST, RESOLVE_RATE, RESOLVE_BURST)
+
+# Розбір введеного користувачем каналу: username без '@' або числовий ID
+def parse_channel_input(channel_input):
+    channel_input = channel_input.strip()
+    if channel_input.startswith("@"):
+        return channel_input[1:]
+    for prefix in ("https://t.me/", "http://t.me/", "t.me/"):
+        if channel_input.startswith(prefix):
+            return channel_input[len(prefix):].strip('/')
+    return int(channel_input)
+
+# ID каналу для збереження: як і раніше, канали, введені числовим ID, зберігаються з цим ID
+def get_input_channel_id(channel_input, chat):
+    target = parse_channel_input(channel_input)
+    return chat.id if isinstance(target, str) else target
+
+# Тип сутності для кешу: 'broadcast', 'megagroup' або 'other'
+def get_entity_type(entity):
+    if getattr(entity, 'broadcast', False):
+        return 'broadcast'
+    if getattr(entity, 'megagroup', False):
+        return 'megagroup'
+    return 'other'
+
+# Пошук у кеші entities за username або ID. Username може перейти до іншого каналу,
+# тому за ним кеш використовується лише протягом ENTITY_USERNAME_TTL
+async def get_cached_entity(target):
+    db = await get_db()
+    if isinstance(target, str):
+        cursor = await db.execute(
+            'SELECT id, username, access_hash, title, type FROM entities WHERE username = ? AND updated_at >= ?',
+            (target, time.time() - ENTITY_USERNAME_TTL)
+        )
+    else:
+        real_id = utils.resolve_id(target)[0] if target < 0 else target
+        cursor = await db.execute(
+            'SELECT id, username, access_hash, title, type FROM entities WHERE id = ?', (real_id,)
+        )
+    row = await cursor.fetchone()
+    return ResolvedChannel(*row) if row else None
+
+# Збереження розпізнаних сутностей у кеш entities
+async def save_entities(resolved):
+    now = time.time()
+    db = await get_db()
+    async with db_lock:
+        await db.executemany(
+            'INSERT OR REPLACE INTO entities (id, username, access_hash, title, type, updated_at) VALUES (?, ?, ?, ?, ?, ?)',
+            [(*entity, now) for entity in resolved]
+        )
+        await db.commit()
 
-    last_id = await get_last_message_id(channel_id)
+# Username, що більше не розпізнається, видаляється з кешу
+async def forget_cached_username(username):
+    db = await get_db()
+    async with db_lock:
+        await db.execute('UPDATE entities SET username = NULL WHERE username = ?', (username,))
+        await db.commit()
 
-    for message in reversed(messages):
-        if message.id > last_id:
-            async with semaphore:
-                success = await safe_forward(message, destination_channel)
-                if success:
-                    logger.info(f"Переслано пропущене повідомлення з каналу {channel_id}, ID повідомлення: {message.id}")
-                else:
-                    logger.error(f"Не вдалося переслати пропущене повідомлення з каналу {channel_id}, ID: {message.id}")
+# Розпізнавання каналу: спочатку кеш entities, потім get_entity з обмеженням швидкості
+async def resolve_channel(channel_input):
+    target = parse_channel_input(channel_input)
+    cached = await get_cached_entity(target)
+    if cached:
+        return cached
 
-    # Оновлення last_message_id
-    new_last_id = messages[0].id
-    await update_last_message_id(channel_id, new_last_id)
+    for attempt in range(1, RESOLVE_RETRIES + 1):
+        try:
+            async with resolve_limiter.slot(None):
+                entity = await client.get_entity(target)
+            break
+        except errors.FloodWaitError as e:
+            resolve_limiter.report_flood_wait(e.seconds)
+            if attempt == RESOLVE_RETRIES or e.seconds > FLOOD_WAIT_MAX:
+                raise
+        except (errors.UsernameNotOccupiedError, errors.UsernameInvalidError):
+            if isinstance(target, str):
+                await forget_cached_username(target)
+            raise
+
+    resolved = ResolvedChannel(
+        entity.id, getattr(entity, 'username', None), getattr(entity, 'access_hash', None),
+        getattr(entity, 'title', None), get_entity_type(entity)
+    )
+    await save_entities([resolved])
+    return resolved
+
+# Повідомлення про прогрес довгої операції, що редагується не частіше PROGRESS_EDIT_INTERVAL
+class ProgressReporter:
+    def __init__(self, message, title, total):
+        self.message = message
+        self.title = title
+        self.total = total
+        self.done = 0
+        self.edited_at = 0
+
+    async def advance(self, count=1):
+        self.done += count
+        if time.monotonic() - self.edited_at >= PROGRESS_EDIT_INTERVAL:
+            await self.edit()
+
+    async def edit(self):
+        self.edited_at = time.monotonic()
+        try:
+            await self.message.edit_text(f"{self.title}: {self.done}/{self.total}")
+        except Exception as e:
+            logger.warning(f"Не вдалося оновити повідомлення про прогрес: {e}")
+
+# Розпізнана сутність не є каналом чи мегагрупою
+class NotAChannelError(Exception):
+    pass
+
+# Розпізнавання каналу для масового додавання та імпорту: приєднання сесії-власника
+# та останнє повідомлення каналу. Повертає (ID каналу, назва, last_message_id або None)
+async def prepare_new_channel(channel_input):
+    chat = await resolve_channel(channel_input)
+    channel_id = get_input_channel_id(channel_input, chat)
+
+    # Перевірка прав доступу
+    if chat.type not in ('broadcast', 'megagroup'):
+        raise NotAChannelError(channel_input)
+
+    await join_channel(get_channel_session(channel_id), channel_id, chat.username)
+    queue_sender_joins([channel_id])
+
+    # Встановлюємо last_message_id на останнє повідомлення
+    async with resolve_limiter.slot(None):
+        messages = await fetch_channel_history(channel_id, limit=1)
+    return channel_id, chat.title, messages[0].id if messages else None
 
 # Додана функція add_new_channel
 async def add_new_channel(channel_input):
     try:
         # Отримання інформації про канал
-        chat = await client.get_entity(channel_input)
+        chat = await resolve_channel(channel_input)
         channel_id = chat.id
 
         # Перевірка, чи це канал або мегагрупа
-        if not (chat.broadcast or chat.megagroup):
+        if chat.type not in ('broadcast', 'megagroup'):
             logger.error(f"Вказаний ID не є каналом або мегагрупою: {channel_input}")
             return
 
         # Збереження каналу в базу даних
         await save_channel(channel_id, chat.title)
+        session = get_channel_session(channel_id)
+        await join_channel(session, channel_id, chat.username)
+        queue_sender_joins([channel_id])
 
         # Отримання останнього повідомлення каналу
         messages = await fetch_channel_history(channel_id, limit=1)
@@ -190,66 +2652,171 @@ async def add_new_channel(channel_input):
         else:
             logger.warning(f"Не вдалося отримати останнє повідомлення для каналу {channel_id}")
 
-        logger.info(f"Канал {chat.title} (ID: {channel_id}) додано.")
+        logger.info(f"Канал {chat.title} (ID: {channel_id}) додано, сесія {session}.")
+        return session
     except Exception as e:
         logger.error(f"Помилка при додаванні каналу: {str(e)}", exc_info=True)
 
-# Функція для обмеження швидкості
-semaphore = asyncio.Semaphore(5)  # Максимум 5 одночасних пересилань
-
 # Оновлений обробник стану додавання каналу
 @dp.message_handler(state=ChannelAdding.waiting_for_channel_id)
 async def add_channel_handler(message: types.Message, state: FSMContext):
     try:
         channel_input = message.text.strip()
-        await add_new_channel(channel_input)
-        await message.reply(f"Канал {channel_input} додано.")
+        session = await add_new_channel(channel_input)
+        if session and len(clients) > 1:
+            await message.reply(f"Канал {channel_input} додано, сесія {session}.")
+        else:
+            await message.reply(f"Канал {channel_input} додано.")
     except Exception as e:
         await message.reply(f"Сталася помилка при додаванні каналу: {str(e)}")
         logger.error(f"Помилка при додаванні каналу: {str(e)}", exc_info=True)
     finally:
         await state.finish()
 
-# Доданий обробник нових повідомлень для кожного каналу
-@client.on(events.NewMessage())
+# Пропущене фільтрами повідомлення просуває позицію каналу, якщо перед ним немає розриву
+# та рядків у черзі, інакше пошук пропусків вважав би його втраченим
+async def skip_live_message(channel_id, message_id):
+    mark_handled(channel_id, message_id)
+    await advance_checkpoint(channel_id, message_id)
+
+# Доданий обробник нових повідомлень для кожного каналу.
+# Реєструється в register_message_handler з фільтром chats=, тому оновлення
+# з інших чатів відкидаються Telethon ще до запуску корутини
 async def new_message_handler(event):
+    started = time.perf_counter()
+    metrics.inc('events_total')
     try:
-        channel_id = event.chat_id  # Використання правильного атрибута для ідентифікації каналу
-        channels = await get_channels()
-        channels_list = [channel[0] for channel in channels]
-        if channel_id not in channels_list:
+        # Перевірка за кешем маршрутизації: O(1) і без звернень до диска
+        channel_id = monitored_channels.get(event.chat_id)
+        if channel_id is None:
+            metrics.inc('skipped_total', 'not_monitored')
             return
 
-        destination_channel = await get_destination_channel()
-        if not destination_channel:
+        if not routing_rules.count:
             logger.error("Канал-приймач не встановлено.")
             return
 
-        # Відфільтровуємо опитування
-        if event.message.poll:
-            logger.info("Повідомлення є опитуванням. Пропускаємо.")
-            return
-
         # Перевірка останнього пересланого повідомлення
         last_id = await get_last_message_id(channel_id)
         if event.message.id <= last_id:
-            logger.info(f"Повідомлення {event.message.id} вже переслано.")
+            metrics.inc('skipped_total', 'already_forwarded')
+            log_summary.note('already_forwarded', "Повідомлення %s вже переслано.", event.message.id)
             return
 
-        async with semaphore:
-            success = await safe_forward(event.message, destination_channel)
-            if success:
-                logger.info(f"Повідомлення {event.message.id} переслано до каналу {destination_channel}")
-                await update_last_message_id(channel_id, event.message.id)
+        # Правила маршрутизації: куди пересилати (опитування за замовчуванням відфільтровуються)
+        destinations = routing_rules.match(channel_id, event.message)
+        if not destinations:
+            metrics.observe('stage_seconds', time.perf_counter() - started, 'filter')
+            metrics.inc('skipped_total', 'no_route')
+            log_summary.note('no_route', "Повідомлення %s з каналу %s не підпадає під жодне правило. Пропускаємо.", event.message.id, channel_id)
+            await skip_live_message(channel_id, event.message.id)
+            return
+
+        # Приймачі, куди той самий вміст уже надходив з цього чи іншого каналу, відкидаються
+        destinations = drop_duplicate_routes(event.message, destinations)
+        metrics.observe('stage_seconds', time.perf_counter() - started, 'filter')
+        if not destinations:
+            metrics.inc('skipped_total', 'duplicate')
+            log_summary.note('duplicate', "Повідомлення %s з каналу %s є дублікатом. Пропускаємо.", event.message.id, channel_id)
+            await skip_live_message(channel_id, event.message.id)
+            return
+
+        remember_message(event.message, destinations)
+        prioritize_catchup(channel_id)
+
+        # Позначка ставиться до await, щоб сторінка догонки, отримана під час запису, не поставила повідомлення вдруге
+        note_catchup_live_message(channel_id, event.message.id)
+        try:
+            # До черги на db_lock обробник не чекає на диск, тому повідомлення потрапляють у чергу в порядку надходження
+            await enqueue_messages(channel_id, [(event.message, destination_id, mode) for destination_id, mode in destinations.items()])
+        except Exception:
+            # Повідомлення не потрапило в чергу, тож догонка має його підхопити
+            catchup_live_ids.get(channel_id, set()).discard(event.message.id)
+            raise
+        mark_handled(channel_id, event.message.id)
+        note_live_message(channel_id, event.message.id)
+        log_summary.note('enqueued', "Повідомлення %s з каналу %s поставлено в чергу.", event.message.id, channel_id)
     except Exception as e:
         logger.error(f"Помилка в обробці повідомлення: {str(e)}", exc_info=True)
 
+# Поточні фільтри обробника нових повідомлень: назва сесії -> events.NewMessage
+new_message_events = {}
+message_handler_refresh_scheduled = False
+
+# Перереєстрація обробника нових повідомлень з фільтром за каналами з кешу маршрутизації.
+# Кожна сесія отримує оновлення лише зі своїх каналів
+def register_message_handler():
+    global message_handler_refresh_scheduled
+    message_handler_refresh_scheduled = False
+    for session, session_client in clients.items():
+        if new_message_events.pop(session, None) is not None:
+            session_client.remove_event_handler(new_message_handler, events.NewMessage)
+    if not monitored_channels:
+        logger.info("Немає каналів для моніторингу, обробник нових повідомлень не зареєстровано.")
+        return
+    chats = collections.defaultdict(list)
+    for channel_id in monitored_channels.values():
+        chats[get_channel_session(channel_id)].append(to_channel_peer(channel_id))
+    for session, peers in chats.items():
+        new_message_events[session] = events.NewMessage(chats=peers)
+        clients[session].add_event_handler(new_message_handler, new_message_events[session])
+    logger.info(f"Обробник нових повідомлень зареєстровано для {len(monitored_channels)} каналів у {len(chats)} сесіях.")
+
+# Відкладена перереєстрація, щоб масові зміни списку каналів перебудовували фільтр один раз
+def schedule_message_handler_refresh():
+    global message_handler_refresh_scheduled
+    if not message_handler_refresh_scheduled:
+        message_handler_refresh_scheduled = True
+        asyncio.get_running_loop().call_soon(register_message_handler)
+
 # Функція для оновлення бази даних
 async def update_database():
     await init_db()
     logger.info("База даних оновлена.")
     return "База даних успішно оновлена."
 
+# Рядок каналу для списків бота; з кількома сесіями показує сесію-власника
+def format_channel(channel_id, title):
+    if len(clients) > 1:
+        return f"{title} ({channel_id}) — сесія {get_channel_session(channel_id)}"
+    return f"{title} ({channel_id})"
+
+# Останній пошуковий запит у кожному чаті: callback_data обмежено 64 байтами, тому запит у кнопки не вміщується
+channel_searches = {}
+
+# Сторінка списку каналів для бота. mode: 'list' — список з ID, 'delete' — кнопки видалення,
+# 'search' — результати пошуку зі списком і кнопками видалення. Повертає (текст, клавіатура)
+async def render_channels_page(mode, chat_id=None, after=None, before=None):
+    query = channel_searches.get(chat_id) if mode == 'search' else None
+    search = channel_search_query(query) if query else None
+    if mode == 'search' and not search:
+        return "Пошуковий запит порожній.", None
+    channels, has_prev, has_next = await get_channels_page(after, before, search)
+    if not channels:
+        return ("Каналів не знайдено." if search else "Список каналів порожній."), None
+
+    total = await count_channels(search)
+    lines = [f"Знайдено каналів за запитом «{query}»: {total}" if search else f"Усього каналів: {total}"]
+    if mode in ('list', 'search'):
+        lines.extend(format_channel(channel_id, title) for channel_id, title in channels)
+    if mode in ('delete', 'search'):
+        lines.append("Виберіть канал, який хочете видалити:")
+
+    keyboard = types.InlineKeyboardMarkup(row_width=2)
+    if mode in ('delete', 'search'):
+        keyboard.add(*(
+            types.InlineKeyboardButton(text=title, callback_data=f'delete_channel_{channel_id}')
+            for channel_id, title in channels
+        ))
+    navigation = []
+    if has_prev:
+        navigation.append(types.InlineKeyboardButton(text="◀️ Назад", callback_data=f'channels_page_{mode}_prev_{channels[0][0]}'))
+    if has_next:
+        navigation.append(types.InlineKeyboardButton(text="Далі ▶️", callback_data=f'channels_page_{mode}_next_{channels[-1][0]}'))
+    if navigation:
+        keyboard.row(*navigation)
+    return '\n'.join(lines), keyboard
+
 # Функція для створення меню клавіатури
 def create_menu_keyboard():
     keyboard = types.ReplyKeyboardMarkup(resize_keyboard=True, row_width=2)
@@ -258,9 +2825,11 @@ def create_menu_keyboard():
         types.KeyboardButton("Додати кілька каналів"),
         types.KeyboardButton("Видалити канал"),
         types.KeyboardButton("Показати список каналів"),
+        types.KeyboardButton("Знайти канал"),
         types.KeyboardButton("Встановити канал-приймач"),
         types.KeyboardButton("Видалити канал-приймач"),
         types.KeyboardButton("Показати канал-приймач"),
+        types.KeyboardButton("Правила маршрутизації"),
         types.KeyboardButton("Обновити базу даних"),
         types.KeyboardButton("Допомога")
     ]
@@ -278,6 +2847,487 @@ async def start(message: types.Message):
     await message.reply(start_message, reply_markup=keyboard)
     logger.info(f"Користувач {message.from_user.id} ініціював бота.")
 
+# Обробник команди /queue
+@dp.message_handler(commands=['queue'])
+async def queue_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    count, retrying, oldest_age = await get_queue_stats()
+    await message.reply(
+        f"Черга пересилання: {count} повідомлень\n"
+        f"Активних смуг: {len(forward_lanes)}\n"
+        f"Очікують повтору: {retrying}\n"
+        f"Вік найстарішого: {int(oldest_age)} с\n"
+        f"Пропущено дублікатів: {dedup_stats['duplicates']} з {dedup_stats['checked']}"
+    )
+    logger.info(f"Користувач {message.from_user.id} запросив стан черги.")
+
+# Обробник команди /stats
+@dp.message_handler(commands=['stats'])
+async def stats_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    lines = [
+        "📊 Статистика з моменту запуску:",
+        f"Подій Telethon: {metrics.counter('events_total')}",
+        f"Поставлено в чергу: {metrics.counter('enqueued_total')}",
+        f"Переслано: {sum(value for (name, _), value in metrics.counters.items() if name == 'forwarded_total')}",
+        f"Спроб пересилання: {metrics.counter('forward_attempts_total', 'ok')} успішних, "
+        f"{metrics.counter('forward_attempts_total', 'error')} з помилками, {metrics.counter('forward_retries_total')} повторів",
+    ]
+    skipped = [(label, value) for (name, label), value in metrics.counters.items() if name == 'skipped_total']
+    if skipped:
+        lines.append("Пропущено: " + ', '.join(f"{label} {value}" for label, value in skipped))
+    errors_by_class = [(label, value) for (name, label), value in metrics.counters.items() if name == 'forward_errors_total']
+    if errors_by_class:
+        lines.append("Помилки: " + ', '.join(f"{label} {value}" for label, value in errors_by_class))
+    if GAP_CHECK_ENABLED:
+        lines.append(f"Перевірок пропусків: {metrics.counter('gap_checks_total')}, догнано пропусків: "
+                     f"{metrics.counter('gaps_repaired_total')} ({metrics.counter('gap_messages_total')} повідомлень)")
+
+    lines.append("\nЗатримки (p50 / p99, с):")
+    for (name, label), histogram in sorted(metrics.histograms.items(), key=lambda item: str(item[0])):
+        if name == 'stage_seconds':
+            lines.append(f"{label}: {histogram.quantile(0.5)} / {histogram.quantile(0.99)} ({histogram.count})")
+    end_to_end = metrics.histogram('end_to_end_seconds')
+    lines.append(f"Від публікації до пересилання: {end_to_end.quantile(0.5)} / {end_to_end.quantile(0.99)} ({end_to_end.count})")
+
+    top_sources = sorted(
+        ((label, value) for (name, label), value in metrics.counters.items() if name == 'forwarded_total'),
+        key=lambda item: item[1], reverse=True
+    )[:10]
+    if top_sources:
+        lines.append("\nНайактивніші канали (переслано, середня затримка):")
+        for source_id, value in top_sources:
+            histogram = metrics.histogram('source_end_to_end_seconds', source_id)
+            average = histogram.sum / histogram.count if histogram.count else 0
+            lines.append(f"{source_id}: {value}, {average:.1f} с")
+
+    if len(clients) > 1:
+        owned = collections.Counter(get_channel_session(channel_id) for channel_id in monitored_channels.values())
+        lines.append("\nСесії (каналів):")
+        for session in clients:
+            banned = session_banned_until.get(session, 0) - time.monotonic()
+            lines.append(f"{session}: {owned[session]}" + (f", FloodWait ще {banned:.0f} с" if banned > 0 else ""))
+
+    await message.reply('\n'.join(lines))
+    logger.info(f"Користувач {message.from_user.id} запросив статистику.")
+
+# Опис правила маршрутизації для відповіді бота
+def format_route(route_id, destination_id, include, exclude, regex, media_types, mode, sources):
+    lines = [f"#{route_id} → {destination_id}" + (" (копіювання)" if mode == 'copy' else ""), f"  Джерела: {sources or 'усі канали'}"]
+    if include:
+        lines.append(f"  Містить: {include}")
+    if exclude:
+        lines.append(f"  Не містить: {exclude}")
+    if regex:
+        lines.append(f"  Regex: {regex}")
+    if media_types:
+        lines.append(f"  Типи: {media_types}")
+    return '\n'.join(lines)
+
+ADD_ROUTE_USAGE = (
+    "Формат (кожен параметр з нового рядка, обов'язковий лише to):\n"
+    "/addrule\n"
+    "to: @канал_приймач\n"
+    "from: @канал1, -100123\n"
+    "include: слово1, слово2\n"
+    "exclude: слово3\n"
+    "regex: шаблон\n"
+    f"media: {', '.join(MEDIA_TYPES)}\n"
+    "mode: forward або copy (копія без заголовка «переслано з», працює і для захищених каналів)"
+)
+
+# Обробник команди /rules
+@dp.message_handler(commands=['rules'])
+async def rules_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    routes = await get_routes()
+    text = "Правила маршрутизації:\n"
+    if destination_channel_id:
+        text += f"#0 → {destination_channel_id} (основний канал-приймач" + (", копіювання" if DELIVERY_MODE == 'copy' else "") + ")\n"
+    text += '\n'.join(
+        format_route(route_id, destination_id, include, exclude, regex, media_types, mode, sources)
+        for route_id, destination_id, include, exclude, regex, media_types, mode, sources in routes
+    )
+    if not routes and not destination_channel_id:
+        text = "Правил маршрутизації немає."
+    await message.reply(text + "\n\n" + ADD_ROUTE_USAGE + "\n\nВидалити правило: /delrule <номер>")
+    logger.info(f"Користувач {message.from_user.id} запросив список правил маршрутизації.")
+
+# Обробник команди /addrule
+@dp.message_handler(commands=['addrule'])
+async def add_rule_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    try:
+        params = {}
+        for line in message.get_args().split('\n'):
+            key, separator, value = line.partition(':')
+            if separator:
+                params[key.strip().lower()] = value.strip()
+        if not params.get('to'):
+            await message.reply(ADD_ROUTE_USAGE)
+            return
+
+        media_types = split_list(params.get('media', '').lower())
+        unknown_types = [media_type for media_type in media_types if media_type not in MEDIA_TYPES]
+        if unknown_types:
+            await message.reply(f"Невідомі типи: {', '.join(unknown_types)}")
+            return
+        regex = params.get('regex', '')
+        if regex:
+            re.compile(regex)
+        mode = params.get('mode', 'forward').lower()
+        if mode not in ('forward', 'copy'):
+            await message.reply("Режим доставки: forward або copy")
+            return
+
+        destination = await resolve_channel(params['to'])
+        destination_id = get_input_channel_id(params['to'], destination)
+        sources = []
+        for source_input in split_list(params.get('from', '')):
+            source = await resolve_channel(source_input)
+            sources.append(get_input_channel_id(source_input, source))
+
+        route_id = await add_route(
+            destination_id, sources,
+            split_list(params.get('include', '').lower()), split_list(params.get('exclude', '').lower()),
+            regex, media_types, mode
+        )
+        await message.reply(f"Правило #{route_id} додано.")
+    except Exception as e:
+        await message.reply(f"Сталася помилка при додаванні правила: {str(e)}")
+        logger.error(f"Помилка при додаванні правила маршрутизації: {str(e)}", exc_info=True)
+
+# Обробник команди /delrule
+@dp.message_handler(commands=['delrule'])
+async def delete_rule_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    try:
+        route_id = int(message.get_args().strip().lstrip('#'))
+    except ValueError:
+        await message.reply("Вкажіть номер правила: /delrule <номер>")
+        return
+    if await delete_route(route_id):
+        await message.reply(f"Правило #{route_id} видалено.")
+    else:
+        await message.reply("Правило не знайдено.")
+
+# Сторінка результатів /search для бота. Повертає (текст, клавіатура)
+async def render_archive_page(chat_id, before=None, after=None):
+    query = archive_searches.get(chat_id)
+    search = channel_search_query(query) if query else None
+    if not search:
+        return "Вкажіть текст для пошуку: /search <текст>", None
+    rows, has_newer, has_older = await search_archive(search, before, after)
+    if not rows:
+        return f"За запитом «{query}» нічого не знайдено.", None
+
+    lines = [f"Знайдено в архіві за запитом «{query}»: {await count_archive_matches(search)}"]
+    for _, source_id, message_id, destination_id, destination_message_id, message_date, media_type, snippet, title in rows:
+        lines.append(
+            f"\n{datetime.fromtimestamp(message_date):%Y-%m-%d %H:%M} · {title or source_id} · {media_type}\n"
+            f"{snippet or '—'}\n"
+            f"{message_link(destination_id, destination_message_id) if destination_message_id else message_link(source_id, message_id)}"
+        )
+    navigation = []
+    if has_newer:
+        navigation.append(types.InlineKeyboardButton(text="◀️ Новіші", callback_data=f'archive_page_newer_{rows[0][0]}'))
+    if has_older:
+        navigation.append(types.InlineKeyboardButton(text="Старіші ▶️", callback_data=f'archive_page_older_{rows[-1][0]}'))
+    keyboard = types.InlineKeyboardMarkup().row(*navigation) if navigation else None
+    return '\n'.join(lines), keyboard
+
+# Обробник команди /search: пошук у локальному архіві пересланих повідомлень
+@dp.message_handler(commands=['search'])
+async def search_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    try:
+        await flush_archive()
+        archive_searches[message.chat.id] = message.get_args().strip()
+        text, keyboard = await render_archive_page(message.chat.id)
+        await message.reply(text, reply_markup=keyboard, disable_web_page_preview=True)
+        logger.info(f"Користувач {message.from_user.id} виконав пошук в архіві.")
+    except Exception as e:
+        await message.reply(f"Сталася помилка при пошуку: {str(e)}")
+        logger.error(f"Помилка при пошуку в архіві: {str(e)}", exc_info=True)
+
+# Обробник кнопок гортання результатів /search
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('archive_page_'))
+async def archive_page_callback(callback_query: types.CallbackQuery):
+    direction, anchor = callback_query.data[len('archive_page_'):].split('_')
+    anchor = int(anchor)
+    try:
+        text, keyboard = await render_archive_page(
+            callback_query.message.chat.id,
+            before=anchor if direction == 'older' else None,
+            after=anchor if direction == 'newer' else None
+        )
+        await callback_query.message.edit_text(text, reply_markup=keyboard, disable_web_page_preview=True)
+    except Exception as e:
+        await callback_query.message.reply("Сталася помилка при гортанні результатів пошуку.")
+        logger.error(f"Помилка при гортанні результатів пошуку: {str(e)}", exc_info=True)
+    finally:
+        await callback_query.answer()
+
+# Імпорт та експорт каналів і контрольних точок
+IMPORT_FORMATS = {'.csv': 'csv', '.jsonl': 'jsonl', '.ndjson': 'jsonl', '.txt': 'txt'}
+EXPORT_COLUMNS = ['type', 'id', 'title', 'last_id', 'channel']
+import_tasks = {}  # ID завдання імпорту -> asyncio.Task
+
+# Заголовок CSV та позиція першого рядка даних
+def read_csv_header(path):
+    with open(path, 'rb') as file:
+        header = file.readline().decode('utf-8-sig', errors='replace').strip()
+        return next(csv.reader([header]), []), file.tell()
+
+# До limit рядків файлу, починаючи з байта position, та позиція після них
+def read_import_lines(path, position, limit):
+    lines = []
+    with open(path, 'rb') as file:
+        file.seek(position)
+        while len(lines) < limit:
+            line = file.readline()
+            if not line:
+                break
+            lines.append(line)
+        return lines, file.tell()
+
+# Записи рядка файлу імпорту з ключами EXPORT_COLUMNS
+def parse_import_line(line, file_format, columns):
+    text = line.decode('utf-8-sig', errors='replace').strip()
+    if not text:
+        return []
+    if file_format == 'jsonl':
+        record = json.loads(text)
+        return [record if isinstance(record, dict) else {'channel': str(record)}]
+    if file_format == 'csv':
+        return [{column.strip().lower(): value.strip() for column, value in zip(columns, next(csv.reader([text])))}]
+    # Як і при масовому додаванні, в рядку може бути кілька каналів через кому
+    return [{'channel': channel.strip()} for channel in text.split(',') if channel.strip()]
+
+def optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+# Один пакет рядків: канали з ID та назвою зберігаються як є (перенесення між хостами),
+# решта розпізнається паралельно через prepare_new_channel. Пакет і позиція у файлі
+# записуються однією транзакцією. Повертає (додано, помилок)
+async def import_lines(job_id, lines, file_format, columns, position, failures):
+    channels = []
+    last_ids = {}
+    to_resolve = []
+    failed = 0
+    for line in lines:
+        try:
+            for record in parse_import_line(line, file_format, columns):
+                channel_id = optional_int(record.get('id'))
+                if (record.get('type') or 'channel') == 'destination':
+                    # Порожній ID тут видалив би поточний канал призначення
+                    if channel_id is None:
+                        raise ValueError("не вказано ID каналу призначення")
+                    await set_destination_channel(channel_id)
+                elif channel_id is not None and record.get('title'):
+                    channels.append((channel_id, record['title']))
+                    last_id = optional_int(record.get('last_id'))
+                    if last_id is not None:
+                        last_ids[channel_id] = last_id
+                elif record.get('channel') or channel_id is not None:
+                    to_resolve.append(record.get('channel') or str(channel_id))
+                else:
+                    raise ValueError("не вказано канал")
+        except (ValueError, TypeError, AttributeError, csv.Error) as e:
+            failed += 1
+            failures.append(f"{line.decode('utf-8', errors='replace').strip()[:100]}: {e}")
+
+    results = await asyncio.gather(*(prepare_new_channel(channel) for channel in to_resolve), return_exceptions=True)
+    for channel, result in zip(to_resolve, results):
+        if isinstance(result, Exception):
+            failed += 1
+            failures.append(f"{channel}: {'не канал' if isinstance(result, NotAChannelError) else result}")
+            continue
+        channel_id, title, last_id = result
+        channels.append((channel_id, title))
+        if last_id is not None:
+            last_ids[channel_id] = last_id
+
+    added = await save_channels_bulk(channels, last_ids, (job_id, position, failed))
+    return added, failed
+
+async def create_import_job(chat_id, path, file_name, file_format):
+    columns, position = await asyncio.to_thread(read_csv_header, path) if file_format == 'csv' else ([], 0)
+    db = await get_db()
+    async with db_lock:
+        cursor = await db.execute(
+            'INSERT INTO import_jobs (chat_id, file_path, file_name, format, columns, file_size, position, updated_at) '
+            'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+            (chat_id, path, file_name, file_format, ','.join(columns), os.path.getsize(path), position, time.time())
+        )
+        await db.commit()
+    return cursor.lastrowid
+
+async def finish_import_job(job_id, status):
+    db = await get_db()
+    async with db_lock:
+        await db.execute('UPDATE import_jobs SET status = ?, updated_at = ? WHERE id = ?', (status, time.time(), job_id))
+        await db.commit()
+
+# Потокове виконання імпорту з позиції, збереженої в import_jobs
+async def run_import_job(job_id):
+    db = await get_db()
+    cursor = await db.execute(
+        'SELECT chat_id, file_path, file_name, format, columns, file_size, position FROM import_jobs WHERE id = ?', (job_id,)
+    )
+    chat_id, path, file_name, file_format, columns, file_size, position = await cursor.fetchone()
+    columns = columns.split(',') if columns else []
+    failures = []
+    try:
+        status = await bot.send_message(chat_id, f"Імпорт #{job_id} з файлу {file_name}: {position}/{file_size} байт")
+        progress = ProgressReporter(status, f"Імпорт #{job_id} з файлу {file_name} (байт)", file_size)
+        progress.done = position
+        while True:
+            lines, next_position = await asyncio.to_thread(read_import_lines, path, position, IMPORT_BATCH_SIZE)
+            if not lines:
+                break
+            await import_lines(job_id, lines, file_format, columns, next_position, failures)
+            await progress.advance(next_position - position)
+            position = next_position
+        await progress.edit()
+        await finish_import_job(job_id, 'done')
+    except asyncio.CancelledError:
+        # Завдання лишається в стані 'running' і продовжиться після перезапуску
+        raise
+    except Exception as e:
+        await finish_import_job(job_id, 'failed')
+        logger.error(f"Помилка імпорту #{job_id}: {str(e)}", exc_info=True)
+        await bot.send_message(chat_id, f"Імпорт #{job_id} перервано: {e}")
+        return
+
+    with contextlib.suppress(OSError):
+        os.remove(path)
+    cursor = await db.execute('SELECT added, failed FROM import_jobs WHERE id = ?', (job_id,))
+    added, failed = await cursor.fetchone()
+    response_message = f"Імпорт #{job_id} завершено: додано {added}, помилок {failed}."
+    if failures:
+        response_message += "\nНе вдалося імпортувати:\n" + "\n".join(failures[:20])
+    await bot.send_message(chat_id, response_message)
+    logger.info(f"Імпорт #{job_id} завершено: додано {added}, помилок {failed}.")
+
+def start_import_job(job_id):
+    task = asyncio.create_task(run_import_job(job_id))
+    import_tasks[job_id] = task
+    task.add_done_callback(lambda _: import_tasks.pop(job_id, None))
+
+# Продовження імпортів, перерваних зупинкою бота
+async def resume_import_jobs():
+    db = await get_db()
+    cursor = await db.execute("SELECT id FROM import_jobs WHERE status = 'running'")
+    for (job_id,) in await cursor.fetchall():
+        logger.info(f"Продовження імпорту #{job_id}.")
+        start_import_job(job_id)
+
+async def stop_import_jobs():
+    tasks = list(import_tasks.values())
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+def format_export_records(records, file_format):
+    if file_format == 'jsonl':
+        return ''.join(json.dumps(record, ensure_ascii=False) + '\n' for record in records)
+    buffer = io.StringIO()
+    csv.DictWriter(buffer, EXPORT_COLUMNS).writerows(records)
+    return buffer.getvalue()
+
+# Експорт каналу-приймача, каналів та їхніх last_message_id у тимчасовий файл частинами по EXPORT_CHUNK_SIZE рядків
+async def export_state(file_format):
+    await flush_pending_writes()
+    db = await get_db()
+    file = tempfile.NamedTemporaryFile('w', encoding='utf-8', newline='', suffix=f'.{file_format}', delete=False)
+    try:
+        if file_format == 'csv':
+            await asyncio.to_thread(file.write, ','.join(EXPORT_COLUMNS) + '\r\n')
+        if destination_channel_id is not None:
+            await asyncio.to_thread(file.write, format_export_records([{'type': 'destination', 'id': destination_channel_id}], file_format))
+        cursor = await db.execute(
+            'SELECT channels.id, channels.title, last_message_ids.last_id FROM channels '
+            'LEFT JOIN last_message_ids ON last_message_ids.channel_id = channels.id ORDER BY channels.id'
+        )
+        while True:
+            rows = await cursor.fetchmany(EXPORT_CHUNK_SIZE)
+            if not rows:
+                break
+            records = [{'type': 'channel', 'id': channel_id, 'title': title, 'last_id': last_id} for channel_id, title, last_id in rows]
+            await asyncio.to_thread(file.write, format_export_records(records, file_format))
+        await cursor.close()
+    finally:
+        file.close()
+    return file.name
+
+# Обробник файлів для імпорту: файл зберігається на диск і обробляється у фоні
+@dp.message_handler(content_types=types.ContentType.DOCUMENT, state='*')
+async def import_document_handler(message: types.Message, state: FSMContext):
+    if message.from_user.id != my_id:
+        return
+
+    await state.finish()
+    document = message.document
+    extension = os.path.splitext(document.file_name or '')[1].lower()
+    file_format = IMPORT_FORMATS.get(extension)
+    if not file_format:
+        await message.reply("Для імпорту надішліть файл .csv, .jsonl або .txt.")
+        return
+    try:
+        os.makedirs(IMPORT_DIR, exist_ok=True)
+        path = os.path.join(IMPORT_DIR, f"{document.file_unique_id}{extension}")
+        # Той самий файл має той самий шлях: повторне завантаження перезаписало б файл, який ще читається
+        db = await get_db()
+        cursor = await db.execute("SELECT id FROM import_jobs WHERE file_path = ? AND status = 'running'", (path,))
+        row = await cursor.fetchone()
+        if row:
+            await message.reply(f"Цей файл уже імпортується (#{row[0]}).")
+            return
+        await document.download(destination_file=path)
+        job_id = await create_import_job(message.chat.id, path, document.file_name, file_format)
+        start_import_job(job_id)
+        logger.info(f"Розпочато імпорт #{job_id} з файлу {document.file_name}.")
+    except Exception as e:
+        await message.reply(f"Сталася помилка при імпорті файлу: {str(e)}")
+        logger.error(f"Помилка при імпорті файлу: {str(e)}", exc_info=True)
+
+# Обробник команди /export
+@dp.message_handler(commands=['export'])
+async def export_command(message: types.Message):
+    if message.from_user.id != my_id:
+        return
+
+    file_format = message.get_args().strip().lower() or 'jsonl'
+    if file_format not in ('csv', 'jsonl'):
+        await message.reply("Формат експорту: /export csv або /export jsonl")
+        return
+    path = None
+    try:
+        path = await export_state(file_format)
+        file_name = f"channels-{datetime.now():%Y%m%d-%H%M%S}.{file_format}"
+        await bot.send_document(message.chat.id, types.InputFile(path, filename=file_name))
+        logger.info(f"Користувач {message.from_user.id} експортував канали.")
+    except Exception as e:
+        await message.reply(f"Сталася помилка при експорті: {str(e)}")
+        logger.error(f"Помилка при експорті: {str(e)}", exc_info=True)
+    finally:
+        if path:
+            with contextlib.suppress(OSError):
+                os.remove(path)
+
 # Обробник повідомлень з кнопками
 @dp.message_handler()
 async def handle_message(message: types.Message):
@@ -291,30 +3341,26 @@ async def handle_message(message: types.Message):
 
     elif message.text == "Додати кілька каналів":
         await MassChannelAdding.waiting_for_channels.set()
-        await message.reply('Введіть ID каналів або їх usernames, розділені комами або новими рядками:')
+        await message.reply(
+            'Введіть ID каналів або їх usernames, розділені комами або новими рядками, '
+            'або надішліть файл .csv, .jsonl чи .txt:'
+        )
         logger.info("Очікування вводу списку каналів для масового додавання")
 
     elif message.text == "Видалити канал":
-        channels = await get_channels()
-        if channels:
-            buttons = [types.InlineKeyboardButton(text=name, callback_data=f'delete_channel_{id}') for id, name in channels]
-            keyboard = types.InlineKeyboardMarkup(row_width=2)
-            keyboard.add(*buttons)
-            await message.reply("Виберіть канал, який хочете видалити:", reply_markup=keyboard)
-            logger.info("Надіслано меню для видалення каналів.")
-        else:
-            await message.reply("Список каналів порожній.")
-            logger.info("Спроба видалити канал, але список порожній.")
+        text, keyboard = await render_channels_page('delete')
+        await message.reply(text, reply_markup=keyboard)
+        logger.info("Надіслано меню для видалення каналів.")
 
     elif message.text == "Показати список каналів":
-        channels = await get_channels()
-        if channels:
-            channel_list = '\n'.join(f"{name} ({id})" for id, name in channels)
-            await message.reply("Список каналів:\n" + channel_list)
-            logger.info("Надіслано список каналів.")
-        else:
-            await message.reply("Список каналів порожній.")
-            logger.info("Спроба показати список каналів, але список порожній.")
+        text, keyboard = await render_channels_page('list')
+        await message.reply(text, reply_markup=keyboard)
+        logger.info("Надіслано список каналів.")
+
+    elif message.text == "Знайти канал":
+        await ChannelSearching.waiting_for_query.set()
+        await message.reply('Введіть частину назви каналу:')
+        logger.info("Очікування вводу запиту для пошуку каналів")
 
     elif message.text == "Встановити канал-приймач":
         await DestinationChannelSetting.waiting_for_destination_channel_id.set()
@@ -345,6 +3391,9 @@ async def handle_message(message: types.Message):
             await message.reply("Канал-приймач не встановлено.")
             logger.info("Спроба показати канал-приймач, але він не встановлено.")
 
+    elif message.text == "Правила маршрутизації":
+        await rules_command(message)
+
     elif message.text == "Обновити базу даних":
         update_result = await update_database()
         await message.reply(update_result)
@@ -371,42 +3420,31 @@ async def mass_add_channels_handler(message: types.Message, state: FSMContext):
 
         added_channels = []
         failed_channels = []
+        new_channels = []
+        new_last_ids = {}
+        status = await message.reply(f"Обробка каналів: 0/{len(channels)}")
+        progress = ProgressReporter(status, "Обробка каналів", len(channels))
 
-        for channel in channels:
+        async def resolve_for_adding(channel):
             try:
-                if channel.startswith("@"):
-                    username = channel[1:]
-                    chat = await client.get_entity(username)
-                    channel_id = chat.id
-                elif channel.startswith("-100"):
-                    channel_id = int(channel)
-                    chat = await client.get_entity(channel_id)
-                else:
-                    channel_id = int(channel)
-                    chat = await client.get_entity(channel_id)
-
-                if chat:
-                    # Перевірка прав доступу
-                    if not (chat.broadcast or chat.megagroup):
-                        failed_channels.append(channel)
-                        logger.error(f"Спроба додати не канал: {channel}")
-                        continue
-
-                    await save_channel(channel_id, chat.title)
-                    added_channels.append(f"{chat.title} ({channel_id})")
-                    logger.info(f"Канал {chat.title} (ID: {channel_id}) додано.")
-
-                    # Встановлюємо last_message_id на останнє повідомлення
-                    messages = await fetch_channel_history(channel_id, limit=1)
-                    if messages:
-                        last_id = messages[0].id
-                        await update_last_message_id(channel_id, last_id)
-                        logger.info(f"Встановлено last_message_id для каналу {channel_id} на {last_id}")
-                else:
-                    failed_channels.append(channel)
+                channel_id, title, last_id = await prepare_new_channel(channel)
+                new_channels.append((channel_id, title))
+                added_channels.append(format_channel(channel_id, title))
+                if last_id is not None:
+                    new_last_ids[channel_id] = last_id
+            except NotAChannelError:
+                failed_channels.append(channel)
+                logger.error(f"Спроба додати не канал: {channel}")
             except Exception as e:
                 failed_channels.append(channel)
                 logger.error(f"Помилка при додаванні каналу {channel}: {str(e)}", exc_info=True)
+            finally:
+                await progress.advance()
+
+        await asyncio.gather(*(resolve_for_adding(channel) for channel in channels))
+        await progress.edit()
+        if new_channels:
+            await save_channels_bulk(new_channels, new_last_ids)
 
         response_message = ""
         if added_channels:
@@ -422,22 +3460,54 @@ async def mass_add_channels_handler(message: types.Message, state: FSMContext):
     finally:
         await state.finish()
 
+# Обробник стану пошуку каналів
+@dp.message_handler(state=ChannelSearching.waiting_for_query)
+async def search_channels_handler(message: types.Message, state: FSMContext):
+    try:
+        channel_searches[message.chat.id] = message.text.strip()
+        text, keyboard = await render_channels_page('search', message.chat.id)
+        await message.reply(text, reply_markup=keyboard)
+        logger.info("Надіслано результати пошуку каналів.")
+    except Exception as e:
+        await message.reply(f"Сталася помилка при пошуку каналів: {str(e)}")
+        logger.error(f"Помилка при пошуку каналів: {str(e)}", exc_info=True)
+    finally:
+        await state.finish()
+
+# Обробник кнопок гортання списку каналів
+@dp.callback_query_handler(lambda c: c.data and c.data.startswith('channels_page_'))
+async def channels_page_callback(callback_query: types.CallbackQuery):
+    mode, direction, anchor = callback_query.data[len('channels_page_'):].split('_')
+    anchor = int(anchor)
+    try:
+        text, keyboard = await render_channels_page(
+            mode, callback_query.message.chat.id,
+            after=anchor if direction == 'next' else None,
+            before=anchor if direction == 'prev' else None
+        )
+        await callback_query.message.edit_text(text, reply_markup=keyboard)
+    except Exception as e:
+        await callback_query.message.reply("Сталася помилка при гортанні списку каналів.")
+        logger.error(f"Помилка при гортанні списку каналів: {str(e)}", exc_info=True)
+    finally:
+        await callback_query.answer()
+
 # Обробник кнопок для видалення каналу
 @dp.callback_query_handler(lambda c: c.data and c.data.startswith('delete_channel_'))
 async def delete_channel_callback(callback_query: types.CallbackQuery):
     channel_id = int(callback_query.data[len('delete_channel_'):])
     try:
-        async with aiosqlite.connect('channels.db') as db:
-            cursor = await db.execute('SELECT title FROM channels WHERE id = ?', (channel_id,))
-            row = await cursor.fetchone()
-            if row:
-                channel_title = row[0]
-                await delete_channel(channel_id)
-                await callback_query.message.reply(f"Канал {channel_title} (ID: {channel_id}) видалено.")
-                logger.info(f"Канал {channel_title} (ID: {channel_id}) видалено.")
-            else:
-                await callback_query.message.reply("Канал не знайдено.")
-                logger.warning(f"Спроба видалити канал з ID {channel_id}, але він не знайдено.")
+        db = await get_db()
+        cursor = await db.execute('SELECT title FROM channels WHERE id = ?', (channel_id,))
+        row = await cursor.fetchone()
+        if row:
+            channel_title = row[0]
+            await delete_channel(channel_id)
+            await callback_query.message.reply(f"Канал {channel_title} (ID: {channel_id}) видалено.")
+            logger.info(f"Канал {channel_title} (ID: {channel_id}) видалено.")
+        else:
+            await callback_query.message.reply("Канал не знайдено.")
+            logger.warning(f"Спроба видалити канал з ID {channel_id}, але він не знайдено.")
     except Exception as e:
         await callback_query.message.reply("Сталася помилка при видаленні каналу.")
         logger.error(f"Помилка при видаленні каналу {channel_id}: {str(e)}", exc_info=True)
@@ -449,23 +3519,12 @@ async def delete_channel_callback(callback_query: types.CallbackQuery):
 async def set_destination_channel_handler(message: types.Message, state: FSMContext):
     try:
         channel_input = message.text.strip()
-        channel_id = None
-        chat = None
-
-        if channel_input.startswith("@"):
-            username = channel_input[1:]
-            chat = await client.get_entity(username)
-            channel_id = chat.id
-        elif channel_input.startswith("-100"):
-            channel_id = int(channel_input)
-            chat = await client.get_entity(channel_id)
-        else:
-            channel_id = int(channel_input)
-            chat = await client.get_entity(channel_id)
+        chat = await resolve_channel(channel_input)
+        channel_id = get_input_channel_id(channel_input, chat)
 
         if chat:
             # Перевірка прав доступу
-            if not (chat.broadcast or chat.megagroup):
+            if chat.type not in ('broadcast', 'megagroup'):
                 await message.reply("Вказаний ID не є каналом.")
                 logger.error(f"Спроба встановити не канал як приймач: {channel_input}")
                 return
@@ -493,48 +3552,94 @@ async def help_message(message: types.Message):
         "🔹 **Додати канал**: Додати один канал для моніторингу\n"
         "🔹 **Додати кілька каналів**: Додати кілька каналів одночасно\n"
         "🔹 **Видалити канал**: Видалити канал зі списку\n"
-        "🔹 **Показати список каналів**: Переглянути додані канали\n"
+        "🔹 **Показати список каналів**: Переглянути додані канали посторінково\n"
+        "🔹 **Знайти канал**: Пошук каналів за назвою з можливістю видалення\n"
         "🔹 **Встановити канал-приймач**: Встановити основний канал-приймач\n"
         "🔹 **Видалити канал-приймач**: Видалити канал-приймач\n"
         "🔹 **Показати канал-приймач**: Переглянути встановлений канал-приймач\n"
+        "🔹 **Правила маршрутизації**: Переглянути правила пересилання до кількох каналів\n"
         "🔹 **Обновити базу даних**: Оновити базу даних\n"
         "🔹 **Допомога**: Отримати цю інформацію\n"
+        "🔹 /queue: Стан черги пересилання\n"
+        "🔹 /stats: Статистика та затримки пересилання\n"
+        "🔹 /addrule, /delrule: Додати або видалити правило маршрутизації\n"
+        "🔹 /search <текст>: Пошук у архіві пересланих повідомлень\n"
+        "🔹 /export [csv|jsonl]: Експорт каналів, каналу-приймача та контрольних точок у файл\n"
+        "🔹 Файл .csv, .jsonl або .txt, надісланий боту, імпортується у фоні\n"
     )
     await message.reply(help_message_text, parse_mode='Markdown')
     logger.info(f"Користувач {message.from_user.id} запросив допомогу.")
 
-# Крок 6: Перевірка пропущених повідомлень при запуску
+# Крок 6: Перевірка пропущених повідомлень при запуску.
+# Канали обробляються паралельно (до CATCHUP_CONCURRENCY одночасно); канали,
+# з яких уже надходять живі повідомлення, обробляються першими
+async def catchup_worker():
+    while catchup_order:
+        channel_id = catchup_order.popleft()
+        try:
+            await process_missed_messages(channel_id)
+        except Exception as e:
+            logger.error(f"Помилка при перевірці пропущених повідомлень каналу {channel_id}: {str(e)}", exc_info=True)
+        finally:
+            await finish_catchup(channel_id)
+
 async def check_missed_messages():
-    channels = await get_channels()
-    destination_channel = await get_destination_channel()
-    if not destination_channel:
-        logger.error("Канал-приймач не встановлено. Не можна обробити пропущені повідомлення.")
-        return
+    try:
+        if not routing_rules.count:
+            logger.error("Канал-приймач не встановлено. Не можна обробити пропущені повідомлення.")
+            return
 
-    for channel_id, _ in channels:
-        await process_missed_messages(channel_id, destination_channel)
-    logger.info("Перевірка пропущених повідомлень завершена.")
+        started = time.monotonic()
+        await asyncio.gather(*(catchup_worker() for _ in range(CATCHUP_CONCURRENCY)))
+        logger.info(f"Перевірка пропущених повідомлень завершена за {time.monotonic() - started:.1f} с.")
+    finally:
+        # Позиції каналів знову просуваються смугами, навіть якщо догонку перервано
+        for channel_id in list(catchup_start_ids):
+            await finish_catchup(channel_id)
+        catchup_order.clear()
 
 # Основна функція
 if __name__ == "__main__":
     async def main():
         await init_db()
+        catchup_task = None
         try:
-            await client.start()
-            logger.info("Telethon клієнт запущено та підключено.")
+            # Позиції каналів фіксуються до підключення: живі повідомлення пересилаються одразу,
+            # а догонка починається з позиції, на якій бот зупинився
+            begin_catchup()
+
+            await start_sessions()
+            logger.info(f"Сесії Telethon ({len(clients)}) запущено та підключено за {time.monotonic() - started_at:.1f} с після запуску.")
+
+            # Воркери одразу продовжують роботу з черги, що залишилася після перезапуску
+            start_forward_workers()
+            await resume_import_jobs()
+            await start_metrics_server()
+            log_summary.start()
 
-            # Перевірка пропущених повідомлень при запуску
-            await check_missed_messages()
+            # Перевірка пропущених повідомлень у фоні, живі повідомлення та команди бота обробляються одразу
+            catchup_task = asyncio.create_task(check_missed_messages())
+            start_gap_detector()
 
             # Запуск клієнта і бота паралельно
             await asyncio.gather(
-                client.run_until_disconnected(),
+                *(session_client.run_until_disconnected() for session_client in clients.values()),
                 dp.start_polling()
             )
         except Exception as e:
             logger.error(f"Сталася помилка: {str(e)}", exc_info=True)
         finally:
-            await client.disconnect()
+            if catchup_task:
+                catchup_task.cancel()
+                await asyncio.gather(catchup_task, return_exceptions=True)
+            await stop_gap_detector()
+            await stop_import_jobs()
+            await stop_forward_workers()
+            await stop_metrics_server()
+            await stop_sessions()
             logger.info("Telethon клієнт відключено.")
+            await close_db()
+            await log_summary.stop()
+            log_listener.stop()
 
     asyncio.run(main())